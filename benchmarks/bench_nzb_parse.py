@@ -0,0 +1,98 @@
+"""
+Compares the streaming NZB parser against the tree-based parsers it replaced.
+
+Usage: python benchmarks/bench_nzb_parse.py [--files N] [--segments N] [--runs N]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from nzbparser import parse_nzb
+
+try:
+    import LordNzb
+except ImportError:
+    LordNzb = None
+
+NZB_NS = "http://www.newzbin.com/DTD/2003/nzb"
+
+
+def write_nzb(path, files, segments, namespace=NZB_NS, name="Synthetic.Release"):
+    """Writes a synthetic NZB with `files` files of `segments` segments each."""
+    xmlns = f' xmlns="{namespace}"' if namespace else ''
+    with open(path, 'w') as f:
+        f.write(f'<?xml version="1.0" encoding="UTF-8"?>\n<nzb{xmlns}>\n')
+        f.write(f'<head><meta type="name">{name}</meta></head>\n')
+        for i in range(files):
+            f.write(f'<file poster="bench" date="1700000000" '
+                    f'subject="{name}.part{i:03d}.rar">\n')
+            f.write('<groups><group>alt.binaries.test</group></groups>\n<segments>\n')
+            for n in range(1, segments + 1):
+                f.write(f'<segment bytes="739232" number="{n}">'
+                        f'{name}.{i:04d}.{n:06d}.part@synthetic.local</segment>\n')
+            f.write('</segments>\n</file>\n')
+        f.write('</nzb>\n')
+
+
+def parse_tree(filepath):
+    """The ElementTree implementation blackhole used before the streaming parser."""
+    root = ET.parse(filepath).getroot()
+    total_bytes = 0
+    for file_element in root.iter():
+        if file_element.tag.rsplit('}', 1)[-1] == 'segment':
+            total_bytes += int(file_element.get('bytes'))
+    return {'filename': os.path.basename(filepath), 'raw_size': total_bytes}
+
+
+def parse_lordnzb(filepath):
+    """The LordNzb implementation producer used before the streaming parser."""
+    m = LordNzb.parser(filepath)
+    return {'filename': m.filename, 'raw_size': m.raw_size}
+
+
+def measure(fn, filepath, runs):
+    """Returns the best wall time and the peak traced allocation of `fn`."""
+    best = float('inf')
+    for _ in range(runs):
+        started = time.perf_counter()
+        fn(filepath)
+        best = min(best, time.perf_counter() - started)
+    tracemalloc.start()
+    result = fn(filepath)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak, result['raw_size']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--files', type=int, default=50)
+    parser.add_argument('--segments', type=int, default=2000)
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    implementations = [('streaming', parse_nzb),
+                       ('no-fp', lambda path: parse_nzb(path, fingerprint=False)),
+                       ('elementtree', parse_tree)]
+    if LordNzb is not None:
+        implementations.append(('lordnzb', parse_lordnzb))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'Synthetic.Release.nzb')
+        write_nzb(path, args.files, args.segments)
+        size_mb = os.path.getsize(path) / 1024 / 1024
+        print(f"NZB: {args.files} files x {args.segments} segments, {size_mb:.1f} MB")
+        print(f"{'parser':<12} {'best (s)':>10} {'peak MB':>10} {'raw_size':>16}")
+        for name, fn in implementations:
+            best, peak, raw_size = measure(fn, path, args.runs)
+            print(f"{name:<12} {best:>10.3f} {peak / 1024 / 1024:>10.1f} {raw_size:>16}")
+
+
+if __name__ == '__main__':
+    main()
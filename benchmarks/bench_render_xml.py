@@ -0,0 +1,87 @@
+"""
+Compares the streaming Newznab XML renderer against the string-concatenating
+renderer it replaced.
+
+Usage: python benchmarks/bench_render_xml.py [--rows N] [--runs N]
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+def legacy_construct_xml(rows_dicts, cat):
+    """The renderer /api used before streaming, building one string with +=."""
+    pre = """<?xml version="1.0" encoding="UTF-8"?>
+    <rss version="2.0" xmlns:atom="http://www.w3.org/2005/Atom" xmlns:newznab="http://www.newznab.com/DTD/2010/feeds/attributes/" encoding="utf-8">
+    <channel><newznab:response offset="0" total="100"/><newznab:apilimits apiCurrent="0" grabCurrent="0"/>"""
+    post = """</channel></rss>"""
+    items = ""
+    for row in rows_dicts:
+        item_xml = "<item>"
+        item_xml += f"<title>{row['name']}</title>"
+        item_xml += f"<link>{main.base_url}/download/{row['filename']}</link>"
+        item_xml += f'<enclosure url=\"{main.base_url}/download/{row["filename"]}\" length=\"{row["raw_size"]}\" type=\"application/x-nzb\"/>'
+        item_xml += f"<pubDate>{main.fake_dt()}</pubDate>"
+        item_xml += f'<newznab:attr name=\"category\" value=\"{cat}\"/>'
+        item_xml += f'<newznab:attr name=\"size\" value=\"{row["raw_size"]}\"/>'
+        item_xml += f'<newznab:attr name=\"files\" value=\"1\"/>'
+        item_xml += f'<newznab:attr name=\"title\" value=\"\"/>'
+        if cat == 5000:
+            item_xml += f'<newznab:attr name=\"season\" value=\"{row["season"]}\"/>'
+            item_xml += f'<newznab:attr name=\"episode\" value=\"{row["episode"]}\"/>'
+        item_xml += "</item>"
+        items += item_xml
+    return f"{pre}{items}{post}"
+
+
+def create_db(rows):
+    conn = sqlite3.connect(':memory:')
+    conn.execute("""
+    CREATE TABLE releases (
+        filename TEXT PRIMARY KEY, name TEXT, raw_size INTEGER, mtype TEXT,
+        imdb_id TEXT, season INTEGER, episode TEXT, tmdb_name TEXT
+    )
+    """)
+    conn.executemany(
+        "INSERT INTO releases VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        [(f"Show.Name.S01E{i:05d}.1080p.WEB-DL.H.264-GRP.nzb",
+          f"Show.Name.S01E{i:05d}.1080p.WEB-DL.H.264-GRP",
+          1500000000 + i, 'show', 'tt0000001', 1, str(i), 'Show Name')
+         for i in range(rows)])
+    return conn
+
+
+def legacy(conn):
+    cursor = conn.execute("SELECT * FROM releases")
+    return legacy_construct_xml(main.rows_to_dicts(cursor, cursor.fetchall()), 5000)
+
+
+def streaming(conn):
+    return "".join(main.construct_xml(conn.execute("SELECT * FROM releases"), 5000, 0, 0))
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    conn = create_db(args.rows)
+    print(f"Rendering {args.rows} rows, best of {args.runs}")
+    for name, fn in [('legacy', legacy), ('streaming', streaming)]:
+        best = float('inf')
+        for _ in range(args.runs):
+            started = time.perf_counter()
+            size = len(fn(conn))
+            best = min(best, time.perf_counter() - started)
+        print(f"{name:<10} {best * 1000:>8.1f} ms {size / 1024:>8.0f} KiB")
+
+
+if __name__ == '__main__':
+    main_()
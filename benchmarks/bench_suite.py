@@ -0,0 +1,467 @@
+"""
+End-to-end benchmarks of the producer, the indexer and the blackhole on
+synthetic data, with a local TMDB stand-in.
+
+Measures producer ingest throughput and rescan time, indexer /api latency
+per function on DBs of several sizes, and blackhole match latency against a
+synthetic mount tree. Results are written as JSON so runs can be compared
+across commits.
+
+Usage: python benchmarks/bench_suite.py [--phases ingest,indexer,blackhole]
+                                        [--movies N] [--shows N] [--seasons N]
+                                        [--episodes N] [--multi-episode F]
+                                        [--tmdb-latency MS] [--tmdb-rate N]
+                                        [--db-rows N,N]
+                                        [--requests N] [--mount-files N]
+                                        [--output FILE] [--workdir DIR]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+from bench_nzb_parse import write_nzb
+
+PHASES = ('ingest', 'indexer', 'blackhole')
+# Bytes per segment written by write_nzb
+SEGMENT_BYTES = 739232
+
+
+def log(message):
+    print(message, file=sys.stderr, flush=True)
+
+
+def alpha(n):
+    """Spells a number in letters, so titles don't look like years or episodes."""
+    letters = ""
+    n += 1
+    while n:
+        n, rem = divmod(n - 1, 26)
+        letters = chr(ord('A') + rem) + letters
+    return letters.capitalize()
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def latency_summary(samples):
+    """Summarizes latencies in seconds as milliseconds."""
+    return {
+        'count': len(samples),
+        'p50_ms': round(percentile(samples, 50) * 1000, 3),
+        'p99_ms': round(percentile(samples, 99) * 1000, 3),
+        'mean_ms': round(sum(samples) / len(samples) * 1000, 3),
+        'max_ms': round(max(samples) * 1000, 3),
+    }
+
+
+def release_names(args):
+    """
+    Yields (relative dir, release name) of a synthetic library: movies,
+    season packs, single episodes and multi-episode releases.
+    """
+    rng = random.Random(args.seed)
+    for i in range(args.movies):
+        title = f"Movie.{alpha(i)}"
+        yield f"movies/{i % 100:02d}", f"{title}.{1980 + i % 45}.1080p.BluRay.x264-GRP"
+    for s in range(args.shows):
+        show = f"Show.{alpha(s)}"
+        for season in range(1, args.seasons + 1):
+            season_dir = f"tv/{show}/Season {season:02d}"
+            yield season_dir, f"{show}.S{season:02d}.1080p.WEB-DL.x264-GRP"
+            episode = 1
+            while episode <= args.episodes:
+                if episode < args.episodes and rng.random() < args.multi_episode:
+                    yield season_dir, f"{show}.S{season:02d}E{episode:02d}E{episode + 1:02d}.720p.HDTV.x264-GRP"
+                    episode += 2
+                else:
+                    yield season_dir, f"{show}.S{season:02d}E{episode:02d}.720p.HDTV.x264-GRP"
+                    episode += 1
+
+
+def generate_corpus(args, nzbs_dir):
+    """
+    Writes the synthetic NZB library.
+
+    :return: A list of (path, subject of the first file, raw size).
+    """
+    rng = random.Random(args.seed)
+    corpus = []
+    for rel_dir, name in release_names(args):
+        dir_path = os.path.join(nzbs_dir, rel_dir)
+        os.makedirs(dir_path, exist_ok=True)
+        path = os.path.join(dir_path, f"{name}.nzb")
+        files, segments = rng.randint(1, 4), rng.randint(5, 40)
+        write_nzb(path, files, segments, name=name)
+        # Files on the mount are named after the subject of the first file
+        corpus.append((path, f"{name}.part000.rar", files * segments * SEGMENT_BYTES))
+    return corpus
+
+
+async def start_fake_tmdb(latency):
+    """
+    Serves a TMDB stand-in on a free local port, answering every search with
+    an id derived from the query after `latency` seconds.
+
+    :return: The runner, the base URL of the API and its request counter.
+    """
+    from aiohttp import web
+
+    stats = {'requests': 0}
+
+    def tmdb_id(text):
+        return zlib.crc32(text.encode()) % 1000000 + 1
+
+    async def search(request):
+        stats['requests'] += 1
+        await asyncio.sleep(latency)
+        return web.json_response({'results': [{'id': tmdb_id(request.query['query'])}]})
+
+    async def tv(request):
+        stats['requests'] += 1
+        await asyncio.sleep(latency)
+        i = int(request.match_info['id'])
+        return web.json_response({'id': i, 'name': f"Show {i}", 'original_name': f"Show {i}",
+                                  'first_air_date': '2020-01-01',
+                                  'external_ids': {'imdb_id': f"tt{i:07d}"}})
+
+    async def movie(request):
+        stats['requests'] += 1
+        await asyncio.sleep(latency)
+        i = int(request.match_info['id'])
+        return web.json_response({'id': i, 'title': f"Movie {i}", 'original_title': f"Movie {i}",
+                                  'release_date': '2020-01-01',
+                                  'external_ids': {'imdb_id': f"tt{i:07d}"}})
+
+    app = web.Application()
+    app.router.add_get('/3/search/{kind}', search)
+    app.router.add_get('/3/tv/{id}', tv)
+    app.router.add_get('/3/movie/{id}', movie)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f"http://127.0.0.1:{port}/3", stats
+
+
+async def bench_ingest(args, corpus):
+    """Measures a cold ingest, a rescan of an unchanged library, and a
+    re-ingest served from the TMDB cache."""
+    import producer
+    from tmdb import TMDBClient
+
+    producer.create_db_and_table()
+    runner, url, tmdb_stats = await start_fake_tmdb(args.tmdb_latency / 1000)
+    results = {'files': len(corpus)}
+    try:
+        rate = {'rate': args.tmdb_rate, 'burst': int(args.tmdb_rate)} if args.tmdb_rate else {}
+        async with TMDBClient('bench', base_url=url, **rate) as client:
+            for run in ('cold_ingest', 'rescan', 'cached_reingest'):
+                if run == 'cached_reingest':
+                    producer.conn.execute(f"DELETE FROM {producer.TABLE_NAME}")
+                    producer.conn.execute("DELETE FROM manifest")
+                    producer.conn.commit()
+                requests_before = tmdb_stats['requests']
+                started = time.perf_counter()
+                await producer.load_nzb_data(client)
+                elapsed = time.perf_counter() - started
+                results[run] = {
+                    'seconds': round(elapsed, 3),
+                    'files_per_sec': round(len(corpus) / elapsed, 1),
+                    'tmdb_requests': tmdb_stats['requests'] - requests_before,
+                }
+                log(f"ingest {run}: {elapsed:.2f}s")
+            results['tmdb_client'] = dict(client.stats)
+    finally:
+        await runner.cleanup()
+    results['releases'] = producer.conn.execute(
+        f"SELECT COUNT(*) FROM {producer.TABLE_NAME}").fetchone()[0]
+    return results
+
+
+def build_indexer_db(path, rows, seed):
+    """
+    Creates a DB of `rows` synthetic releases, about 70% episodes of shows
+    with 200 releases each and 30% movies with 3 releases each.
+
+    :return: The lists of (imdb_id, season) and movie imdb ids in the DB.
+    """
+    from schema import TABLE_NAME, migrate
+
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    migrate(conn)
+    shows = max(1, rows * 7 // 10 // 200)
+    movies = max(1, (rows - shows * 200) // 3)
+    show_seasons = [(f"tt{1000000 + s:07d}", season) for s in range(shows) for season in range(1, 6)]
+    movie_ids = [f"tt{5000000 + m:07d}" for m in range(movies)]
+
+    def releases():
+        for s in range(shows):
+            title = f"Show {alpha(s)}"
+            for season in range(1, 6):
+                for episode in range(1, 21):
+                    for quality in ('720p', '1080p'):
+                        name = f"{title.replace(' ', '.')}.S{season:02d}E{episode:02d}.{quality}.WEB-DL.x264-GRP"
+                        yield (f"{name}.nzb", name, rng.randint(10 ** 8, 10 ** 10), 'show',
+                               f"tt{1000000 + s:07d}", season, str(episode), episode, episode,
+                               s, title, title, f"/nzbs/{name}.nzb",
+                               quality, 'WEB-DL', 'H.264', 'GRP')
+        for m in range(movies):
+            title = f"Movie {alpha(m)}"
+            for quality in ('720p', '1080p', '2160p'):
+                name = f"{title.replace(' ', '.')}.2020.{quality}.BluRay.x264-GRP"
+                yield (f"{name}.nzb", name, rng.randint(10 ** 9, 5 * 10 ** 10), 'movie',
+                       f"tt{5000000 + m:07d}", None, None, None, None,
+                       100000 + m, title, title, f"/nzbs/{name}.nzb",
+                       quality, 'Blu-ray', 'H.264', 'GRP')
+
+    conn.executemany(
+        f"INSERT INTO {TABLE_NAME} (filename, name, raw_size, mtype, imdb_id, season, episode, "
+        f"episode_start, episode_end, tmdb_id, tmdb_name, tmdb_original_name, path, "
+        f"resolution, source, codec, release_group) "
+        f"VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", releases())
+    # Ingested in batches of 50 releases per second
+    conn.execute(f"UPDATE {TABLE_NAME} SET ingested_at = 1700000000 + rowid / 50")
+    conn.commit()
+    conn.execute("PRAGMA optimize")
+    conn.close()
+    return show_seasons, movie_ids, shows
+
+
+def bench_indexer(args, workdir):
+    """Measures /api latency per function through the Flask app."""
+    import main
+    import snapshot
+    from cache import ResponseCache
+    from db import ReadOnlyDB
+
+    results = {}
+    for rows in args.db_rows:
+        path = os.path.join(workdir, f"indexer-{rows}.db")
+        started = time.perf_counter()
+        show_seasons, movie_ids, shows = build_indexer_db(path, rows, args.seed)
+        log(f"indexer: built a {rows} row DB in {time.perf_counter() - started:.1f}s")
+        snapshot_path = os.path.join(workdir, f"indexer-{rows}.snapshot")
+        started = time.perf_counter()
+        snapshot.build(path, snapshot_path)
+        log(f"indexer: built its snapshot in {time.perf_counter() - started:.1f}s")
+
+        main.db = ReadOnlyDB(path)
+        client = main.app.test_client()
+        rng = random.Random(args.seed)
+
+        def tvsearch():
+            imdb_id, season = rng.choice(show_seasons)
+            return f"/api?t=tvsearch&imdbid={imdb_id}&season={season}"
+
+        def tvsearch_ep():
+            return f"{tvsearch()}&ep={rng.randint(1, 20)}"
+
+        def tvsearch_filtered():
+            return f"{tvsearch()}&resolution=1080p,2160p"
+
+        def movie():
+            return f"/api?t=movie&imdbid={rng.choice(movie_ids)}"
+
+        def search():
+            return f"/api?t=search&cat=5000&q=Show {alpha(rng.randrange(shows))}"
+
+        def rss():
+            # Polls from a cursor a few hundred releases behind the newest
+            newest = 1700000000 + rows // 50
+            return f"/api?t=rss&cursor={newest - rng.randint(1, 10)}-0"
+
+        fixed = tvsearch()
+        functions = {
+            'caps': lambda: "/api?t=caps",
+            'tvsearch': tvsearch,
+            'tvsearch_ep': tvsearch_ep,
+            'tvsearch_filtered': tvsearch_filtered,
+            'movie': movie,
+            'search': search,
+            'rss': rss,
+            'rss_head': lambda: "/api?t=rss",
+            'tvsearch_cached': lambda: fixed,
+            'tvsearch_snapshot': tvsearch,
+            'tvsearch_ep_snapshot': tvsearch_ep,
+            'tvsearch_filtered_snapshot': tvsearch_filtered,
+            'movie_snapshot': movie,
+        }
+        size_results = {}
+        for function, make_url in functions.items():
+            # Only the cached variant is served from the response cache
+            cached = function.endswith('_cached')
+            main.response_cache = ResponseCache(1024 if cached else 0, 64 * 1024 * 1024 if cached else 0)
+            # Only the snapshot variants are served from the catalog snapshot
+            main.catalog_snapshot = (snapshot.SnapshotReader(snapshot_path)
+                                     if function.endswith('_snapshot') else None)
+            samples = []
+            for _ in range(args.requests):
+                url = make_url()
+                started = time.perf_counter()
+                response = client.get(url)
+                response.get_data()
+                samples.append(time.perf_counter() - started)
+                assert response.status_code == 200, (url, response.status_code)
+            size_results[function] = latency_summary(samples)
+            log(f"indexer {rows} rows {function}: p50 {size_results[function]['p50_ms']}ms "
+                f"p99 {size_results[function]['p99_ms']}ms")
+        main.db.close()
+        results[str(rows)] = size_results
+    return results
+
+
+def bench_blackhole(args, workdir, corpus):
+    """
+    Measures the mount catalog scans and the latency of matching NZBs
+    against it, parsing included.
+    """
+    import blackhole
+
+    logging.getLogger('producer').setLevel(logging.WARNING)
+    mount = os.path.join(workdir, 'mount')
+    rng = random.Random(args.seed)
+    # Sparse files of the NZBs' sizes, plus unrelated files
+    for i, (_, name, raw_size) in enumerate(corpus):
+        dir_path = os.path.join(mount, 'library', f"{i % 50:02d}", f"{i:06d}")
+        os.makedirs(dir_path, exist_ok=True)
+        with open(os.path.join(dir_path, name), 'wb') as f:
+            f.truncate(raw_size)
+    for i in range(args.mount_files):
+        dir_path = os.path.join(mount, 'other', f"{i % 200:03d}")
+        os.makedirs(dir_path, exist_ok=True)
+        with open(os.path.join(dir_path, f"Other.Release.{alpha(i)}.mkv"), 'wb') as f:
+            f.truncate(rng.randint(10 ** 8, 10 ** 10))
+
+    catalog = blackhole.MountCatalog(mount, os.path.join(workdir, 'catalog.json'))
+    results = {'mount_files': len(corpus) + args.mount_files}
+    started = time.perf_counter()
+    catalog.refresh(full=True)
+    results['full_scan_seconds'] = round(time.perf_counter() - started, 3)
+    started = time.perf_counter()
+    catalog.refresh(full=False)
+    results['delta_scan_seconds'] = round(time.perf_counter() - started, 3)
+
+    samples = []
+    matched = 0
+    for path, _, _ in corpus:
+        started = time.perf_counter()
+        metadata = blackhole.parse_nzb_metadata(path)
+        found = catalog.lookup(metadata['name'], metadata['raw_size'])
+        samples.append(time.perf_counter() - started)
+        matched += found is not None
+    results['match'] = latency_summary(samples)
+    results['matched'] = matched
+    log(f"blackhole: full scan {results['full_scan_seconds']}s, "
+        f"match p50 {results['match']['p50_ms']}ms p99 {results['match']['p99_ms']}ms")
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--phases', default=','.join(PHASES))
+    parser.add_argument('--movies', type=int, default=500)
+    parser.add_argument('--shows', type=int, default=40)
+    parser.add_argument('--seasons', type=int, default=3)
+    parser.add_argument('--episodes', type=int, default=10)
+    parser.add_argument('--multi-episode', type=float, default=0.1,
+                        help="fraction of episodes released as double episodes")
+    parser.add_argument('--tmdb-latency', type=float, default=50, help="milliseconds")
+    parser.add_argument('--tmdb-rate', type=float,
+                        help="TMDB requests per second, TMDB_RATE_LIMIT by default")
+    parser.add_argument('--db-rows', default='10000,100000',
+                        help="comma separated sizes of the indexer DBs")
+    parser.add_argument('--requests', type=int, default=500, help="requests per /api function")
+    parser.add_argument('--mount-files', type=int, default=20000,
+                        help="unrelated files in the synthetic mount")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="JSON results file, printed to stdout by default")
+    parser.add_argument('--workdir', help="kept after the run, a temporary dir is used by default")
+    args = parser.parse_args()
+    args.db_rows = [int(rows) for rows in args.db_rows.split(',') if rows]
+    phases = [phase for phase in args.phases.split(',') if phase]
+    for phase in phases:
+        if phase not in PHASES:
+            parser.error(f"unknown phase {phase}")
+
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix='ud-bench-'))
+    os.makedirs(workdir, exist_ok=True)
+    nzbs_dir = os.path.join(workdir, 'nzbs')
+    # The modules read their configuration when imported
+    os.environ.update({
+        'CONFIG_DIR': workdir,
+        'NZBS_DIR': nzbs_dir,
+        'PRODUCER_WATCH': 'false',
+        'BLACKHOLE_UD_MOUNT_PATH': os.path.join(workdir, 'mount'),
+        'BLACKHOLE_CATALOG_PATH': os.path.join(workdir, 'catalog.json'),
+        'GZIP_CACHE_DIR': os.path.join(workdir, 'gzip-cache'),
+    })
+    if args.output:
+        args.output = os.path.abspath(args.output)
+    # The producer logs to producer.log in the working directory
+    cwd = os.getcwd()
+    os.chdir(workdir)
+
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'params': {key: value for key, value in vars(args).items() if key not in ('output', 'workdir')},
+        'results': {},
+    }
+    try:
+        corpus = None
+        if 'ingest' in phases or 'blackhole' in phases:
+            started = time.perf_counter()
+            corpus = generate_corpus(args, nzbs_dir)
+            log(f"Generated {len(corpus)} NZBs in {time.perf_counter() - started:.1f}s")
+        if 'ingest' in phases:
+            report['results']['ingest'] = asyncio.run(bench_ingest(args, corpus))
+        if 'indexer' in phases:
+            report['results']['indexer'] = bench_indexer(args, workdir)
+        if 'blackhole' in phases:
+            report['results']['blackhole'] = bench_blackhole(args, workdir, corpus)
+    finally:
+        os.chdir(cwd)
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main_()
@@ -1,14 +1,18 @@
 # blackhole.py
 
+import json
 import logging
 import os
+import queue
+import threading
 import time
 import xml.etree.ElementTree as ET
 
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
-from producer import process_single_nzb
+import metrics
+from nzbparser import parse_nzb
 
 # Define logger
 logger = logging.getLogger('producer')
@@ -24,6 +28,53 @@ base_watch_path = os.environ.get("BLACKHOLE_BASE_WATCH_PATH")
 radarr_path = os.environ.get("BLACKHOLE_RADARR_PATH")
 sonarr_path = os.environ.get("BLACKHOLE_SONARR_PATH")
 ud_mount_path = os.environ.get("BLACKHOLE_UD_MOUNT_PATH")
+catalog_path = os.environ.get(
+    "BLACKHOLE_CATALOG_PATH",
+    os.path.join(base_watch_path or '.', '.ud-mount-catalog.json'))
+# Seconds between delta scans of the mount, and between full rescans which
+# catch changes that don't bump a directory's mtime.
+catalog_refresh_interval = int(
+    os.environ.get("BLACKHOLE_CATALOG_REFRESH_INTERVAL", "300"))
+catalog_full_scan_interval = int(
+    os.environ.get("BLACKHOLE_CATALOG_FULL_SCAN_INTERVAL", "21600"))
+# Minimum seconds between delta scans triggered by a lookup miss
+catalog_miss_refresh_interval = int(
+    os.environ.get("BLACKHOLE_CATALOG_MISS_REFRESH_INTERVAL", "30"))
+# Watching the mount only helps if the FS delivers events for it, which
+# rclone mounts don't do for remote changes, so it is opt-in.
+catalog_watch = os.environ.get("BLACKHOLE_CATALOG_WATCH",
+                               "false").lower() in ("1", "true", "yes")
+# Port serving /metrics and textfile the metrics are written to, both off by
+# default
+metrics_port = int(os.environ.get("BLACKHOLE_METRICS_PORT", "0"))
+metrics_textfile = os.environ.get("BLACKHOLE_METRICS_TEXTFILE")
+# Threads matching NZBs, and how many NZBs may wait for one
+workers = int(os.environ.get("BLACKHOLE_WORKERS", "4"))
+queue_size = int(os.environ.get("BLACKHOLE_QUEUE_SIZE", "1000"))
+# Unmatched NZBs are retried after an exponentially growing delay, in
+# seconds, until they match or run out of attempts.
+retry_initial_delay = int(os.environ.get("BLACKHOLE_RETRY_INITIAL_DELAY", "30"))
+retry_max_delay = int(os.environ.get("BLACKHOLE_RETRY_MAX_DELAY", "3600"))
+retry_max_attempts = int(os.environ.get("BLACKHOLE_RETRY_MAX_ATTEMPTS", "10"))
+retry_state_path = os.environ.get(
+    "BLACKHOLE_RETRY_STATE_PATH",
+    os.path.join(base_watch_path or '.', '.ud-retry-schedule.json'))
+
+MATCH_SECONDS = metrics.histogram(
+    'blackhole_match_seconds',
+    "Time to match an NZB against the mount, including refreshes on a miss")
+MATCHES = metrics.counter(
+    'blackhole_matches_total', "NZBs matched against the mount", ['result'])
+REFRESH_SECONDS = metrics.histogram(
+    'blackhole_catalog_refresh_seconds', "Time to refresh the mount catalog", ['kind'])
+CATALOG_FILES = metrics.gauge(
+    'blackhole_catalog_files', "Files in the mount catalog")
+QUEUE_DEPTH = metrics.gauge(
+    'blackhole_queue_depth', "NZBs waiting for a worker")
+RETRIES = metrics.counter(
+    'blackhole_retries_total', "Unmatched NZBs scheduled for a retry or given up on", ['result'])
+RETRY_PENDING = metrics.gauge(
+    'blackhole_retry_pending', "NZBs in the retry schedule")
 
 
 def getPath(isRadarr, create=False):
@@ -41,6 +92,425 @@ def getPath(isRadarr, create=False):
     return finalPath
 
 
+class MountCatalog:
+    """
+    Index of the files under the UD mount, mapping basename to (path, size).
+
+    The catalog is persisted to `state_path` so restarts don't need a full
+    walk of the mount. Directory mtimes are recorded alongside the files so
+    `refresh` only has to list directories that changed since the last scan.
+    """
+
+    def __init__(self, root, state_path):
+        self.root = root
+        self.state_path = state_path
+        self.lock = threading.Lock()
+        # Serializes scans, which workers may trigger concurrently on misses
+        self.refresh_lock = threading.Lock()
+        # Serializes saves, which share the temporary file
+        self.save_lock = threading.Lock()
+        # dir path -> [mtime_ns, [subdir names], {file name: size}]
+        self.dirs = {}
+        # basename -> {path: size}
+        self.names = {}
+        self.last_refresh = 0
+        self.last_full_scan = 0
+
+    def __len__(self):
+        return sum(len(paths) for paths in self.names.values())
+
+    def load(self):
+        """Loads the catalog persisted by a previous run, if any."""
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable catalog {self.state_path}: {e}")
+            return
+        if state.get('root') != self.root:
+            logger.info("Catalog was built for another mount path, ignoring it")
+            return
+        with self.lock:
+            self.dirs = state['dirs']
+            self.names = {}
+            for dir_path, (_, _, files) in self.dirs.items():
+                for name, size in files.items():
+                    self.names.setdefault(name, {})[os.path.join(dir_path, name)] = size
+            self.last_full_scan = state.get('last_full_scan', 0)
+        logger.info(f"Loaded {len(self)} catalog entries from {self.state_path}")
+
+    def save(self):
+        """
+        Atomically persists the catalog to `state_path`.
+
+        The directories are copied under the lookup lock and serialized
+        outside of it, so lookups aren't held up by the dump.
+        """
+        with self.lock:
+            state = {
+                'root': self.root,
+                'last_full_scan': self.last_full_scan,
+                'dirs': {dir_path: [mtime_ns, list(subdirs), dict(files)]
+                         for dir_path, (mtime_ns, subdirs, files) in self.dirs.items()},
+            }
+        tmp_path = f"{self.state_path}.tmp"
+        with self.save_lock:
+            with open(tmp_path, 'w') as f:
+                json.dump(state, f)
+            os.replace(tmp_path, self.state_path)
+
+    def _set_files(self, dir_path, files):
+        known = self.dirs.get(dir_path)
+        old_files = known[2] if known else {}
+        changed = False
+        for name in old_files.keys() - files.keys():
+            self._forget(dir_path, name)
+            changed = True
+        for name, size in files.items():
+            if old_files.get(name) != size:
+                self.names.setdefault(name, {})[os.path.join(dir_path, name)] = size
+                changed = True
+        return changed
+
+    def _forget(self, dir_path, name):
+        paths = self.names.get(name)
+        if paths is not None:
+            paths.pop(os.path.join(dir_path, name), None)
+            if not paths:
+                del self.names[name]
+
+    def _forget_dir(self, dir_path):
+        known = self.dirs.pop(dir_path, None)
+        if known is None:
+            return
+        for name in known[2]:
+            self._forget(dir_path, name)
+        for subdir in known[1]:
+            self._forget_dir(os.path.join(dir_path, subdir))
+
+    def add(self, path):
+        """Adds or updates a single file, e.g. from a watchdog event."""
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        dir_path, name = os.path.split(path)
+        with self.lock:
+            self.names.setdefault(name, {})[path] = size
+            known = self.dirs.get(dir_path)
+            if known is not None:
+                known[2][name] = size
+
+    def remove(self, path):
+        """Removes a single file or a whole directory from the catalog."""
+        dir_path, name = os.path.split(path)
+        with self.lock:
+            self._forget_dir(path)
+            self._forget(dir_path, name)
+            known = self.dirs.get(dir_path)
+            if known is not None:
+                known[2].pop(name, None)
+                if name in known[1]:
+                    known[1].remove(name)
+
+    def refresh(self, full=False):
+        """
+        Brings the catalog up to date with the mount.
+
+        Only directories whose mtime changed are listed again, unless `full`
+        is set in which case every directory is.
+
+        :return: True if any entry was added or removed.
+        """
+        with self.refresh_lock:
+            return self._refresh(full)
+
+    def _refresh(self, full):
+        started = time.monotonic()
+        changed = False
+        seen_dirs = set()
+        stack = [self.root]
+        while stack:
+            dir_path = stack.pop()
+            try:
+                mtime_ns = os.stat(dir_path).st_mtime_ns
+            except OSError:
+                continue
+            seen_dirs.add(dir_path)
+            with self.lock:
+                known = self.dirs.get(dir_path)
+            if not full and known is not None and known[0] == mtime_ns:
+                stack.extend(os.path.join(dir_path, d) for d in known[1])
+                continue
+
+            subdirs = []
+            files = {}
+            try:
+                with os.scandir(dir_path) as it:
+                    for entry in it:
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                subdirs.append(entry.name)
+                            elif entry.is_file():
+                                files[entry.name] = entry.stat().st_size
+                        except OSError:
+                            continue
+            except OSError as e:
+                logger.warning(f"Failed to list {dir_path}: {e}")
+                continue
+
+            with self.lock:
+                changed = self._set_files(dir_path, files) or changed
+                self.dirs[dir_path] = [mtime_ns, subdirs, files]
+            stack.extend(os.path.join(dir_path, d) for d in subdirs)
+
+        with self.lock:
+            gone = [d for d in self.dirs if d not in seen_dirs]
+            for d in gone:
+                self._forget_dir(d)
+        changed = changed or bool(gone)
+
+        self.last_refresh = time.monotonic()
+        REFRESH_SECONDS.observe(self.last_refresh - started,
+                                kind="full" if full else "delta")
+        if full:
+            self.last_full_scan = time.time()
+        logger.debug("Catalog %s scan took %.2fs, %d files",
+                     "full" if full else "delta",
+                     self.last_refresh - started, len(self))
+        return changed
+
+    def refresh_on_miss(self):
+        """
+        Runs a delta scan after a lookup miss, at most once per interval.
+
+        :return: True if the catalog may have changed since the miss, so the
+                 lookup is worth repeating.
+        """
+        missed = time.monotonic()
+        with self.refresh_lock:
+            # Another worker refreshed the catalog while this one waited
+            if self.last_refresh >= missed:
+                return True
+            if missed - self.last_refresh < catalog_miss_refresh_interval:
+                return False
+            changed = self._refresh(False)
+        if changed:
+            self.save()
+        return changed
+
+    def lookup(self, name, raw_size):
+        """
+        Finds a file with the given basename whose size is within 3% of
+        `raw_size`.
+
+        :return: The full path of the matching file, or None.
+        """
+        tolerance = raw_size * 0.03
+        with self.lock:
+            candidates = list(self.names.get(name, {}).items())
+        for path, size in candidates:
+            if abs(size - raw_size) <= tolerance:
+                logger.debug("Matching file found %s", path)
+                return path
+            logger.debug("File size mismatch %s", path)
+        return None
+
+    def run_refresher(self):
+        """Periodically refreshes and persists the catalog, forever."""
+        while True:
+            time.sleep(catalog_refresh_interval)
+            try:
+                full = time.time() - self.last_full_scan >= catalog_full_scan_interval
+                if self.refresh(full=full) or full:
+                    self.save()
+            except Exception:
+                logger.exception("Catalog refresh failed")
+
+
+class MountEventHandler(FileSystemEventHandler):
+    """
+    Keeps the mount catalog up to date from file system events on the mount.
+    """
+
+    def __init__(self, catalog):
+        super().__init__()
+        self.catalog = catalog
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self.catalog.add(event.src_path)
+
+    def on_deleted(self, event):
+        self.catalog.remove(event.src_path)
+
+    def on_moved(self, event):
+        self.catalog.remove(event.src_path)
+        if not event.is_directory:
+            self.catalog.add(event.dest_path)
+
+
+mount_catalog = MountCatalog(ud_mount_path, catalog_path)
+metrics.REGISTRY.on_collect(lambda: CATALOG_FILES.set(len(mount_catalog)))
+
+
+class RetrySchedule:
+    """
+    NZBs that didn't match the mount yet, with the time of their next try.
+
+    The schedule is persisted to `state_path` so pending retries survive a
+    restart. Delays double with every attempt, from `retry_initial_delay` up
+    to `retry_max_delay`.
+    """
+
+    def __init__(self, state_path):
+        self.state_path = state_path
+        self.lock = threading.Lock()
+        # processing path -> {'is_radarr', 'attempts', 'next_at'}
+        self.entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, path):
+        with self.lock:
+            return path in self.entries
+
+    def load(self):
+        """Loads the schedule persisted by a previous run, if any."""
+        try:
+            with open(self.state_path) as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable retry schedule {self.state_path}: {e}")
+            return
+        with self.lock:
+            self.entries = {path: entry for path, entry in entries.items()
+                            if os.path.exists(path)}
+        logger.info(f"Loaded {len(self)} pending retries from {self.state_path}")
+
+    def save(self):
+        """Atomically persists the schedule to `state_path`."""
+        tmp_path = f"{self.state_path}.tmp"
+        with self.lock:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.entries, f)
+            os.replace(tmp_path, self.state_path)
+
+    def schedule(self, path, is_radarr):
+        """
+        Schedules the next try of an unmatched NZB.
+
+        :return: False if the NZB ran out of attempts and was dropped from
+                 the schedule.
+        """
+        with self.lock:
+            entry = self.entries.get(path, {'is_radarr': is_radarr, 'attempts': 0})
+            if entry['attempts'] >= retry_max_attempts:
+                self.entries.pop(path, None)
+                exhausted = True
+            else:
+                delay = min(retry_max_delay, retry_initial_delay * 2 ** entry['attempts'])
+                entry['attempts'] += 1
+                entry['next_at'] = time.time() + delay
+                self.entries[path] = entry
+                exhausted = False
+        self.save()
+        if exhausted:
+            RETRIES.inc(result="exhausted")
+            return False
+        RETRIES.inc(result="scheduled")
+        logger.info(f"Retrying {path} in {delay}s, attempt {entry['attempts']}/{retry_max_attempts}")
+        return True
+
+    def remove(self, path):
+        """Drops an NZB from the schedule, once it matched."""
+        with self.lock:
+            removed = self.entries.pop(path, None) is not None
+        if removed:
+            self.save()
+
+    def pop_due(self):
+        """
+        Returns the NZBs whose retry is due, as (path, is_radarr) tuples.
+
+        They stay in the schedule until they match or are rescheduled, so a
+        crash before the retry doesn't lose them.
+        """
+        now = time.time()
+        with self.lock:
+            due = [(path, entry['is_radarr']) for path, entry in self.entries.items()
+                   if entry['next_at'] <= now]
+            for path, _ in due:
+                # Leases the entry, so it isn't submitted again while queued
+                self.entries[path]['next_at'] = now + retry_max_delay
+        return due
+
+    def run(self, submit):
+        """Submits NZBs to `submit` as their retries fall due, forever."""
+        while True:
+            time.sleep(1)
+            try:
+                for path, is_radarr in self.pop_due():
+                    submit(path, is_radarr)
+            except Exception:
+                logger.exception("Retry scheduling failed")
+
+
+retry_schedule = RetrySchedule(retry_state_path)
+metrics.REGISTRY.on_collect(lambda: RETRY_PENDING.set(len(retry_schedule)))
+
+
+class WorkerPool:
+    """
+    Bounded pool of threads matching NZBs, fed by a queue.
+
+    An NZB already waiting in the queue or being processed is not queued
+    again, whether from the watch or the processing dir, so duplicate events
+    and overlapping retries are harmless.
+    """
+
+    def __init__(self, size, max_queued):
+        self.size = size
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.pending = set()
+        self.lock = threading.Lock()
+
+    def start(self):
+        for i in range(self.size):
+            threading.Thread(target=self._work, name=f'blackhole-worker-{i}',
+                             daemon=True).start()
+
+    def submit(self, path, is_radarr):
+        """Queues an NZB, blocking while the queue is full."""
+        key = (is_radarr, os.path.basename(path))
+        with self.lock:
+            if key in self.pending:
+                return
+            self.pending.add(key)
+        self.queue.put((path, is_radarr))
+
+    def _work(self):
+        while True:
+            path, is_radarr = self.queue.get()
+            try:
+                process_single_nzb(path, is_radarr)
+            except Exception:
+                logger.exception(f"Failed to process {path}")
+            finally:
+                with self.lock:
+                    self.pending.discard((is_radarr, os.path.basename(path)))
+                self.queue.task_done()
+
+
+worker_pool = WorkerPool(workers, queue_size)
+metrics.REGISTRY.on_collect(lambda: QUEUE_DEPTH.set(worker_pool.queue.qsize()))
+
+
 class ArrEventHandler(FileSystemEventHandler):
     """
     Handles file system events for new NZB files downloaded by Radarr/Sonarr.
@@ -52,69 +522,88 @@ class ArrEventHandler(FileSystemEventHandler):
         self.path_name = getPath(is_radarr, create=True)
 
     def on_created(self, event):
-        if not event.is_directory and not event.src_path.endswith('.nzb'):
+        if event.is_directory or not event.src_path.endswith('.nzb'):
             return
-        logger.info(f"File '{event.src_path}' created, processing...!")
-        process_single_nzb(event.src_path, self.is_radarr)
+        logger.info(f"File '{event.src_path}' created, queueing...!")
+        worker_pool.submit(event.src_path, self.is_radarr)
+
+
+def link_atomically(target, link_path):
+    """Points `link_path` at `target`, replacing any existing link."""
+    tmp_path = f"{link_path}.tmp"
+    try:
+        os.remove(tmp_path)
+    except FileNotFoundError:
+        pass
+    os.symlink(target, tmp_path)
+    os.replace(tmp_path, link_path)
 
 
 def process_single_nzb(filepath, is_radarr):
-    # filepath is an absolute path
+    # filepath is an absolute path, either in the watch dir or, for retries
+    # and leftovers of a previous run, already in the processing dir
     arr_path = getPath(is_radarr)
     processing_path = os.path.join(arr_path, 'processing')
     completed_path = os.path.join(arr_path, 'completed')
 
-    nzb_metadata = parse_nzb_metadata(filepath)
+    # Move file to processing directory
+    processing_file = os.path.join(processing_path,
+                                   os.path.basename(filepath))
+    if filepath != processing_file:
+        try:
+            os.rename(filepath, processing_file)
+            logger.debug(f"NZB moved to processing: {processing_file}")
+        except FileNotFoundError:
+            # Queued twice, by its event and the startup scan
+            logger.debug(f"NZB already processed: {filepath}")
+            return
+        except OSError as e:
+            logger.error(f"Error moving NZB: {e}")
+            return
+    elif not os.path.exists(processing_file):
+        logger.debug(f"NZB already processed: {filepath}")
+        return
+
+    nzb_metadata = parse_nzb_metadata(processing_file)
     if nzb_metadata is None:
-        logger.error(f"Failed to parse NZB metadata for {filepath}")
+        # Events arrive while the arr may still be writing the NZB, so it is
+        # retried like an unmatched one before it is given up on
+        if retry_schedule.schedule(processing_file, is_radarr):
+            logger.warning(f"Failed to parse NZB metadata for {processing_file}, retrying later")
+            return
+        logger.error(f"Failed to parse NZB metadata for {processing_file}, giving up")
+        remove_from_processing(processing_file)
         return
 
     file_to_search = nzb_metadata['name']
     file_raw_size = nzb_metadata['raw_size']
 
-    # Move file to processing directory
-    processing_file = os.path.join(processing_path,
-                                   os.path.basename(filepath))
-    try:
-        os.rename(filepath, processing_file)
-        logger.debug(f"NZB moved to processing: {processing_file}")
-    except OSError as e:
-        logger.error(f"Error moving NZB: {e}")
-        return
-
-    # Search for matching file in ud_mount_path
-    found_file = None
-    for root, _, files in os.walk(ud_mount_path):
-        for file in files:
-            if file == file_to_search:
-                full_path = os.path.join(root, file)
-                logger.debug("Checking file for size %s", full_path)
-                # Check file size for up to 3% tolerance
-                file_size = os.path.getsize(full_path)
-                tolerance = file_raw_size * 0.03
-                if abs(file_size - file_raw_size) <= tolerance:
-                    logger.debug("Matching file found %s", full_path)
-                    found_file = full_path
-                    break
-                else:
-                    logger.debug("File size mismatch %s", full_path)
-        if found_file:
-            break
+    # Search for matching file in the mount catalog
+    with MATCH_SECONDS.time():
+        found_file = mount_catalog.lookup(file_to_search, file_raw_size)
+        if found_file is None and mount_catalog.refresh_on_miss():
+            found_file = mount_catalog.lookup(file_to_search, file_raw_size)
+    MATCHES.inc(result="hit" if found_file else "miss")
 
     if found_file:
-        # Create symlink from `completed` to found file
-        # Delete nzb from processing
+        # Create symlink from `completed` to found file, replacing any
+        # existing one
         symlink_path = os.path.join(completed_path, file_to_search)
-        # Delete existing symlink if it exists
-        if os.path.exists(symlink_path):
-            os.remove(symlink_path)
         logger.debug("Creating symlink [%s] -> [%s]", symlink_path, found_file)
-        os.symlink(found_file, symlink_path)
+        link_atomically(found_file, symlink_path)
         logger.info(f"Symlink created: {symlink_path}")
+        retry_schedule.remove(processing_file)
+    elif retry_schedule.schedule(processing_file, is_radarr):
+        # Keep the NZB in processing until UD exposes the file
+        logger.info(f"File not found yet: {file_to_search}")
+        return
     else:
-        logger.info(f"File not found: {file_to_search}")
+        logger.info(f"File not found, giving up: {file_to_search}")
 
-    # Delete file from processing (assuming processing is done)
+    remove_from_processing(processing_file)
+
+
+def remove_from_processing(processing_file):
     try:
         os.remove(processing_file)
         logger.debug(f"NZB deleted from processing: {processing_file}")
@@ -122,39 +611,56 @@ def process_single_nzb(filepath, is_radarr):
         logger.debug(f"Error deleting NZB from processing: {e}")
 
 
+def submit_existing(is_radarr):
+    """
+    Queues the NZBs left in the watch and processing dirs while the
+    blackhole wasn't running. NZBs waiting for a retry are left to the
+    schedule.
+    """
+    arr_path = getPath(is_radarr, create=True)
+    for dir_path in (arr_path, os.path.join(arr_path, 'processing')):
+        with os.scandir(dir_path) as it:
+            for entry in it:
+                if (entry.name.endswith('.nzb') and entry.is_file()
+                        and entry.path not in retry_schedule):
+                    logger.info(f"Found existing NZB '{entry.path}', queueing...!")
+                    worker_pool.submit(entry.path, is_radarr)
+
+
 def parse_nzb_metadata(filepath):
     """Parses NZB metadata to extract relevant information."""
     try:
-        tree = ET.parse(filepath)
-        root = tree.getroot()
-        # Assuming the NZB XML has a structure like this:
-        # <nzb>
-        #   <file subject="...">
-        #     <segments>
-        #       <segment bytes="..." number="..."/>
-        #       ...
-        #     </segments>
-        #   </file>
-        #   ...
-        # </nzb>
-
-        total_bytes = 0
-        for file_element in root.findall('file'):
-            for segment_element in file_element.find('segments').findall(
-                    'segment'):
-                total_bytes += int(segment_element.get('bytes'))
-
+        # Matching is by name and size, so the content isn't fingerprinted
+        metadata = parse_nzb(filepath, fingerprint=False)
         return {
-            'filename': os.path.basename(filepath),
-            'name': root.find('file').get('subject'),  # Extract subject as name
-            'raw_size': total_bytes
+            'filename': metadata['filename'],
+            'name': metadata['subject'],  # Extract subject as name
+            'raw_size': metadata['raw_size']
         }
-    except ET.ParseError:
-        logger.exception(f"Error parsing NZB file: {filepath}")
+    except (ET.ParseError, ValueError, OSError) as e:
+        logger.warning(f"Error parsing NZB file {filepath}: {e}")
         return None
 
 
 if __name__ == '__main__':
+    metrics.start_exporter(metrics_port, metrics_textfile)
+    mount_catalog.load()
+    mount_catalog.refresh(full=mount_catalog.last_full_scan == 0)
+    mount_catalog.save()
+    threading.Thread(target=mount_catalog.run_refresher, daemon=True).start()
+
+    mount_observer = None
+    if catalog_watch:
+        mount_observer = Observer()
+        mount_observer.schedule(MountEventHandler(mount_catalog),
+                                ud_mount_path, recursive=True)
+        mount_observer.start()
+
+    retry_schedule.load()
+    worker_pool.start()
+    threading.Thread(target=retry_schedule.run, args=(worker_pool.submit,),
+                     daemon=True).start()
+
     radarr_handler = ArrEventHandler(is_radarr=True)
     sonarr_handler = ArrEventHandler(is_radarr=False)
 
@@ -167,12 +673,18 @@ if __name__ == '__main__':
     radarr_observer.start()
     sonarr_observer.start()
 
+    # Started after the observers, so no NZB falls between the two
+    submit_existing(is_radarr=True)
+    submit_existing(is_radarr=False)
+
     try:
         while True:
             time.sleep(0.5)
     except KeyboardInterrupt:
         radarr_observer.stop()
         sonarr_observer.stop()
+        if mount_observer:
+            mount_observer.stop()
 
     radarr_observer.join()
     sonarr_observer.join()
\ No newline at end of file
@@ -0,0 +1,96 @@
+import threading
+from collections import OrderedDict
+
+
+class ResponseCache:
+    """
+    LRU cache of rendered responses, bounded by entry count and total size.
+
+    Entries are tagged with the catalog generation published by the
+    producer. As soon as a lookup sees a newer generation the whole cache is
+    dropped, so responses never outlive the data they were rendered from.
+    Generations only move forward: a request that read the generation just
+    before a bump neither drops the cache nor gets its response cached.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # Responses larger than this are never cached
+        self.max_entry_bytes = max_bytes // 8
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.generation = None
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    def _check_generation(self, generation):
+        """
+        Drops the cache if `generation` is newer than its own.
+
+        :return: Whether `generation` is the current one.
+        """
+        if self.generation is not None and generation < self.generation:
+            return False
+        if generation != self.generation:
+            if self.entries:
+                self.stats['invalidations'] += 1
+            self.entries.clear()
+            self.bytes = 0
+            self.generation = generation
+        return True
+
+    def get(self, key, generation):
+        """Returns the cached body for `key`, or None on a miss."""
+        with self.lock:
+            body = self.entries.get(key) if self._check_generation(generation) else None
+            if body is None:
+                self.stats['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return body
+
+    def put(self, key, generation, body: bytes):
+        """Caches `body`, unless the catalog changed while it was rendered."""
+        if len(body) > self.max_entry_bytes:
+            return
+        with self.lock:
+            if generation != self.generation:
+                return
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= len(old)
+            self.entries[key] = body
+            self.bytes += len(body)
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.bytes -= len(evicted)
+                self.stats['evictions'] += 1
+
+    def wrap(self, key, generation, chunks):
+        """
+        Passes through a generator of str chunks, caching the full body once
+        it has been completely rendered.
+        """
+        parts = []
+        size = 0
+        for chunk in chunks:
+            chunk = chunk.encode('utf-8')
+            size += len(chunk)
+            if parts is not None:
+                if size > self.max_entry_bytes:
+                    parts = None
+                else:
+                    parts.append(chunk)
+            yield chunk
+        if parts is not None:
+            self.put(key, generation, b"".join(parts))
+
+    def info(self):
+        """Returns the cache statistics and current size."""
+        with self.lock:
+            return dict(self.stats,
+                        entries=len(self.entries),
+                        bytes=self.bytes,
+                        generation=self.generation)
@@ -0,0 +1,50 @@
+import os
+import sqlite3
+import threading
+from urllib.request import pathname2url
+
+# Bytes of the DB file memory-mapped by each connection
+SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+# Page cache per connection, negative values are in KiB
+SQLITE_CACHE_SIZE = int(os.environ.get('SQLITE_CACHE_SIZE', -64 * 1024))
+# Prepared statements kept per connection
+SQLITE_CACHED_STATEMENTS = int(os.environ.get('SQLITE_CACHED_STATEMENTS', 256))
+
+
+class ReadOnlyDB:
+    """
+    Read-only access to the catalog DB written by the producer.
+
+    Each thread gets its own connection, opened once with `mode=ro` and tuned
+    for reads, so requests don't pay for connection setup and never take a
+    write lock. The producer keeps the DB in WAL mode, so readers aren't
+    blocked while it writes.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.local = threading.local()
+
+    def connection(self):
+        """Returns the connection of the calling thread, opening it if needed."""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(f"file:{pathname2url(self.path)}?mode=ro",
+                                   uri=True,
+                                   cached_statements=SQLITE_CACHED_STATEMENTS)
+            conn.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+            conn.execute(f"PRAGMA cache_size={SQLITE_CACHE_SIZE}")
+            conn.execute("PRAGMA query_only=ON")
+            self.local.conn = conn
+        return conn
+
+    def execute(self, query: str, params=()):
+        """Executes a query on the calling thread's connection."""
+        return self.connection().execute(query, params)
+
+    def close(self):
+        """Closes the calling thread's connection."""
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
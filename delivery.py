@@ -0,0 +1,171 @@
+"""
+Delivery of NZB files shared by both indexer servers.
+
+NZBs are served with validators so clients can revalidate them with a
+conditional GET, and gzip encoded when the client accepts it. Compressed
+copies are created lazily in an on-disk cache, keyed by the path, size and
+mtime of the NZB, and the least recently used ones are evicted once the
+cache outgrows its size bound. Both servers send files with sendfile where
+the platform supports it.
+"""
+import gzip
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+GZIP_CACHE_DIR = os.environ.get(
+    'GZIP_CACHE_DIR', os.path.join(os.environ.get('CONFIG_DIR', '/config'), 'gzip-cache'))
+# Total size of the compressed copies, 0 disables gzip encoding
+GZIP_CACHE_MAX_BYTES = int(os.environ.get('GZIP_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+GZIP_LEVEL = int(os.environ.get('GZIP_LEVEL', 6))
+# How often the last use of a cached copy is recorded, in seconds
+GZIP_TOUCH_INTERVAL = 3600
+
+
+def etag(st: os.stat_result):
+    """
+    Builds the ETag of a file from its stat, in the same format aiohttp's
+    FileResponse uses, so both servers send the same validators.
+    """
+    return f"{st.st_mtime_ns:x}-{st.st_size:x}"
+
+
+def accepts_gzip(accept_encoding):
+    """Returns whether an Accept-Encoding header allows gzip."""
+    for coding in (accept_encoding or "").lower().split(','):
+        name, _, params = coding.partition(';')
+        if name.strip() not in ('gzip', '*'):
+            continue
+        params = params.replace(' ', '')
+        if params.startswith('q='):
+            try:
+                return float(params[2:]) > 0
+            except ValueError:
+                return False
+        return True
+    return False
+
+
+class GzipCache:
+    """
+    On-disk cache of gzip compressed copies of files.
+
+    Copies are written to a temporary file and renamed into place, so
+    concurrent workers never see partial copies. Their mtime is set to the
+    source's, so they carry the same Last-Modified, and their atime records
+    when they were last used.
+    """
+
+    def __init__(self, root: str, max_bytes: int, level: int = GZIP_LEVEL):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.level = level
+        self.bytes = None
+        self.lock = threading.Lock()
+
+    def _cache_path(self, path, st):
+        key = f"{path}\0{st.st_size}\0{st.st_mtime_ns}".encode('utf-8', 'surrogateescape')
+        return os.path.join(self.root, hashlib.sha1(key).hexdigest() + '.gz')
+
+    def get(self, path: str, st: os.stat_result):
+        """
+        Returns the path of the compressed copy of a file, creating it if
+        needed.
+
+        :param path: The path of the file.
+        :param st: The stat of the file.
+        :return: The path of the compressed copy, or None if it couldn't be
+                 created.
+        """
+        cache_path = self._cache_path(path, st)
+        try:
+            cached = os.stat(cache_path)
+            now = time.time()
+            if now - cached.st_atime > GZIP_TOUCH_INTERVAL:
+                os.utime(cache_path, ns=(time.time_ns(), st.st_mtime_ns))
+            return cache_path
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning("Could not read gzip cache entry for %s: %s", path, e)
+            return None
+
+        try:
+            os.makedirs(self.root, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix='.tmp')
+            try:
+                with open(path, 'rb') as src, os.fdopen(fd, 'wb') as raw, \
+                        gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=self.level, mtime=0) as dst:
+                    shutil.copyfileobj(src, dst)
+                os.utime(tmp_path, ns=(time.time_ns(), st.st_mtime_ns))
+                os.replace(tmp_path, cache_path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        except OSError as e:
+            logger.warning("Could not compress %s into the gzip cache: %s", path, e)
+            return None
+
+        self._added(os.path.getsize(cache_path))
+        return cache_path
+
+    def _added(self, size):
+        with self.lock:
+            if self.bytes is None:
+                # Includes the new copy
+                self.bytes = self._total()
+            else:
+                self.bytes += size
+            if self.bytes > self.max_bytes:
+                self._evict()
+
+    def _entries(self):
+        with os.scandir(self.root) as it:
+            return [(entry.path, entry.stat()) for entry in it
+                    if entry.name.endswith('.gz') and entry.is_file()]
+
+    def _total(self):
+        return sum(st.st_size for _, st in self._entries())
+
+    def _evict(self):
+        # Evicts down to 90% of the bound, so evictions are batched
+        entries = sorted(self._entries(), key=lambda entry: entry[1].st_atime)
+        self.bytes = sum(st.st_size for _, st in entries)
+        target = self.max_bytes * 9 // 10
+        evicted = 0
+        for path, st in entries:
+            if self.bytes <= target:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            self.bytes -= st.st_size
+            evicted += 1
+        logger.info("Evicted %d entries from the gzip cache, %d bytes left", evicted, self.bytes)
+
+
+gzip_cache = GzipCache(GZIP_CACHE_DIR, GZIP_CACHE_MAX_BYTES) if GZIP_CACHE_MAX_BYTES > 0 else None
+
+
+def select_representation(path: str, accept_encoding):
+    """
+    Picks the file to send for an NZB: its gzip compressed copy when the
+    client accepts gzip and the cache is enabled, the NZB itself otherwise.
+
+    :param path: The path of the NZB.
+    :param accept_encoding: The Accept-Encoding header of the request.
+    :return: A tuple of (path, stat, content encoding) of the file to send.
+    """
+    st = os.stat(path)
+    if gzip_cache is not None and accepts_gzip(accept_encoding):
+        cache_path = gzip_cache.get(path, st)
+        if cache_path is not None:
+            return cache_path, os.stat(cache_path), 'gzip'
+    return path, st, None
@@ -1,8 +1,20 @@
 from datetime import datetime, timedelta
-from flask import Flask, send_file, abort, request, Response
+from email.utils import formatdate
+from flask import Flask, send_file, abort, g, request, Response
+from werkzeug.exceptions import HTTPException
 import logging
 import os
 import sqlite3
+import time
+from urllib.parse import quote
+from xml.sax.saxutils import escape
+
+import delivery
+import metrics
+import snapshot
+from cache import ResponseCache
+from db import ReadOnlyDB
+from schema import FTS_TABLE_NAME, STATE_TABLE_NAME, TABLE_NAME, fts_query, unique_content
 
 app = Flask(__name__)
 
@@ -13,14 +25,101 @@ if __name__ != '__main__':
 
 base_url = os.environ.get('INDEXER_BASE_URL')
 nzbs_root_dir = os.environ.get('NZBS_DIR')
-config_dir = "/config"
+config_dir = os.environ.get('CONFIG_DIR', '/config')
 db_name = "nzbs.db"
-table_name = "nzbs"
+table_name = TABLE_NAME
+fts_table_name = FTS_TABLE_NAME
 db_path = os.path.join(config_dir, db_name)
+db = ReadOnlyDB(db_path)
 
 MTYPE_MOVIE = "movie"
 MTYPE_SHOW = "show"
 
+# Maximum number of results of a title search on the JSON routes
+SEARCH_LIMIT = 100
+# Page size of Newznab responses, as advertised by caps
+API_DEFAULT_LIMIT = 100
+API_MAX_LIMIT = 100
+# Depth of the RSS feed for clients without a cursor or timestamp
+RSS_MAX_ITEMS = int(os.environ.get('RSS_MAX_ITEMS', 1000))
+# Rows rendered per chunk of a streamed XML response
+XML_CHUNK_ROWS = 200
+# Query parameters filtering on the attributes parsed from release names,
+# mapped to their columns
+ATTRIBUTE_PARAMS = {
+    'resolution': 'resolution',
+    'source': 'source',
+    'codec': 'codec',
+    'group': 'release_group',
+}
+# Newznab attributes rendered for the attribute columns
+ATTRIBUTE_ATTRS = (
+    ('resolution', 'resolution'),
+    ('video', 'codec'),
+    ('source', 'source'),
+    ('team', 'release_group'),
+)
+# Extra entities to escape in XML attribute values
+XML_ATTR_ENTITIES = {'"': "&quot;"}
+# Bounds of the /api response cache, by number of responses and total bytes
+API_CACHE_ENTRIES = int(os.environ.get('API_CACHE_ENTRIES', 1024))
+API_CACHE_MAX_BYTES = int(os.environ.get('API_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+
+response_cache = ResponseCache(API_CACHE_ENTRIES, API_CACHE_MAX_BYTES)
+# Catalog snapshot published by the producer, empty to always query the DB
+CATALOG_SNAPSHOT_PATH = os.environ.get('CATALOG_SNAPSHOT_PATH', os.path.join(config_dir, "catalog.snapshot"))
+
+catalog_snapshot = snapshot.SnapshotReader(CATALOG_SNAPSHOT_PATH) if CATALOG_SNAPSHOT_PATH else None
+
+# Newznab functions labelled separately in the request metrics
+API_FUNCTIONS = ('caps', 'tvsearch', 'movie', 'search', 'rss')
+
+REQUEST_SECONDS = metrics.histogram(
+    'indexer_request_seconds', "Time to serve a request, including sending the body",
+    ['route', 'function'])
+SQL_SECONDS = metrics.histogram(
+    'indexer_sql_seconds', "Time spent executing queries and fetching rows", ['query'])
+ROW_CONVERSION_SECONDS = metrics.histogram(
+    'indexer_row_conversion_seconds', "Time converting rows to dicts for JSON responses")
+RENDER_SECONDS = metrics.histogram(
+    'indexer_render_seconds', "Time rendering XML responses, excluding row fetches")
+FILE_LOOKUP_SECONDS = metrics.histogram(
+    'indexer_file_lookup_seconds', "Time resolving a download to a file", ['source'])
+SNAPSHOT_SECONDS = metrics.histogram(
+    'indexer_snapshot_lookup_seconds', "Time spent looking up releases in the catalog snapshot")
+RESPONSE_CACHE = metrics.gauge(
+    'indexer_response_cache', "Counters and size of the /api response cache", ['stat'])
+
+def collect_response_cache():
+    for stat, value in response_cache.info().items():
+        if value is not None:
+            RESPONSE_CACHE.set(value, stat=stat)
+
+metrics.REGISTRY.on_collect(collect_response_cache)
+
+# Attribute filters are supported by every search function
+ATTRIBUTE_SUPPORTED_PARAMS = ",".join(ATTRIBUTE_PARAMS)
+
+CAPS_XML = f"""<caps>
+        <server appversion="1.0.0" version="0.1" title="UDIndexer" strapline="" />
+        <limits max="{API_MAX_LIMIT}" default="{API_DEFAULT_LIMIT}"/>
+        <registration available="no" open="no"/>
+        <searching>
+            <search available="yes" supportedParams="q,{ATTRIBUTE_SUPPORTED_PARAMS}"/>
+            <tv-search available="yes" supportedParams="q,imdbid,season,ep,{ATTRIBUTE_SUPPORTED_PARAMS}"/>
+            <movie-search available="yes" supportedParams="q,imdbid,{ATTRIBUTE_SUPPORTED_PARAMS}"/>
+            <rss available="yes" supportedParams="cat,since,cursor,{ATTRIBUTE_SUPPORTED_PARAMS}"/>
+        </searching>
+        <categories>
+            <category id="2000" name="Movies"></category>
+            <category id="5000" name="TV"></category>
+        </categories>
+        <genres>
+            <genre id="2" categoryid="2000" name="All"/>
+            <genre id="5" categoryid="5000" name="All"/>
+        </genres>
+        </caps>"""
+
 class NZB:
     """Represents an NZB file with its metadata."""
 
@@ -38,6 +137,45 @@ if __name__ != '__main__':
     app.logger.handlers = gunicorn_logger.handlers
     app.logger.setLevel(gunicorn_logger.level)
 
+def api_function_label(route, function):
+    """Returns the function label of a request, bounded to known functions."""
+    if route != "/api":
+        return ""
+    return function if function in API_FUNCTIONS else "other"
+
+@app.before_request
+def start_request_timer():
+    g.started = time.perf_counter()
+
+@app.after_request
+def observe_request_time(response):
+    started = g.get('started')
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        function = api_function_label(route, request.args.get('t'))
+        # Streamed bodies are only sent after this hook, so the time is
+        # observed once the response is closed
+        response.call_on_close(lambda: REQUEST_SECONDS.observe(
+            time.perf_counter() - started, route=route, function=function))
+    return response
+
+@app.route("/metrics")
+def serve_metrics():
+    """
+    Serves the indexer metrics in the Prometheus text format.
+    """
+    return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
+
+def execute(name, query, params=()):
+    """Executes a query, timing it under `name`."""
+    with SQL_SECONDS.time(query=name):
+        return db.execute(query, params)
+
+def fetch_all(cursor):
+    """Fetches the remaining rows of a cursor, timing it."""
+    with SQL_SECONDS.time(query="fetch"):
+        return cursor.fetchall()
+
 @app.route('/download/<filename>')
 def download_nzb(filename):
     """
@@ -48,17 +186,193 @@ def download_nzb(filename):
     """
     app.logger.info('New download request for %s', filename)
     try:
-        # Check if file exists on disk
-        for root, _, files in os.walk(nzbs_root_dir):
-            if filename in files:
-                full_path = os.path.join(root, filename)
-                app.logger.debug("Found %s at path %s", filename, full_path)
-                return send_file(full_path, as_attachment=True)
-        abort(404)
+        full_path = find_nzb_path(filename)
+        if full_path is None:
+            abort(404)
+        app.logger.debug("Found %s at path %s", filename, full_path)
+        path, st, encoding = delivery.select_representation(
+            full_path, request.headers.get('Accept-Encoding'))
+        # Sent with the server's file wrapper, which uses sendfile, and
+        # answered with 304 when the client's copy is still current
+        response = send_file(path,
+                             mimetype='application/x-nzb',
+                             as_attachment=True,
+                             download_name=os.path.basename(full_path),
+                             etag=delivery.etag(st),
+                             last_modified=st.st_mtime,
+                             conditional=True)
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+        response.headers['Vary'] = 'Accept-Encoding'
+        return response
+    except HTTPException:
+        raise
     except Exception as e:
         app.logger.exception(f"Error downloading or parsing NZB file {filename}: {e}")
         abort(500)
 
+def find_nzb_path(filename):
+    """
+    Resolves an NZB filename to its path on disk.
+
+    The path recorded by the producer is used when it still points at a file,
+    otherwise NZBS_DIR is walked as a fallback.
+
+    :param filename: The name of the NZB file.
+    :return: The full path of the NZB file, or None if it does not exist.
+    """
+    try:
+        with FILE_LOOKUP_SECONDS.time(source="db"):
+            row = execute("path", f"SELECT path FROM {table_name} WHERE filename=?", (filename,)).fetchone()
+            found = row and row[0] and os.path.isfile(row[0])
+        if found:
+            return row[0]
+        app.logger.debug("Path index miss for %s, walking %s", filename, nzbs_root_dir)
+    except sqlite3.Error as e:
+        app.logger.warning("Path index lookup failed for %s: %s", filename, e)
+
+    with FILE_LOOKUP_SECONDS.time(source="walk"):
+        for root, _, files in os.walk(nzbs_root_dir):
+            if filename in files:
+                return os.path.join(root, filename)
+    return None
+
+def query_releases(where, params, offset=0, limit=-1, order="rowid DESC", name="releases", columns="*"):
+    """
+    Queries a page of the releases matching a filter, newest first.
+
+    :param where: The SQL condition of the filter.
+    :param params: The parameters of the condition.
+    :param offset: The number of releases to skip.
+    :param limit: The maximum number of releases, -1 for no limit.
+    :param order: The SQL ordering of the releases.
+    :param name: The name of the query in the metrics.
+    :param columns: The SQL columns to select.
+    :return: The cursor of the results.
+    """
+    # Ordering by rowid keeps pages stable and is free on the search indexes
+    query = (f"SELECT {columns} FROM {table_name} WHERE {where} AND {unique_content(table_name)} "
+             f"ORDER BY {order} LIMIT ? OFFSET ?")
+    app.logger.debug("Executing query %s", query)
+    return execute(name, query, (*params, limit, offset))
+
+def count_releases(where, params, limit=-1, name="count_releases"):
+    """
+    Counts the releases matching a filter.
+
+    :param limit: The number to stop counting at, -1 for no limit.
+    :return: The number of releases.
+    """
+    query = (f"SELECT COUNT(*) FROM (SELECT 1 FROM {table_name} "
+             f"WHERE {where} AND {unique_content(table_name)} LIMIT ?)")
+    return execute(name, query, (*params, limit)).fetchone()[0]
+
+def attribute_filter(attributes, alias=None):
+    """
+    Builds the SQL condition restricting releases to the accepted values of
+    their attributes. The attribute columns compare case-insensitively.
+
+    :param attributes: Pairs of (attribute column, accepted values).
+    :param alias: The name the releases table is referred to by, if any.
+    :return: A tuple of (where, params), where being empty without attributes.
+    """
+    prefix = f"{alias}." if alias else ""
+    where = "".join(f" AND {prefix}{column} IN ({', '.join('?' * len(values))})"
+                    for column, values in attributes)
+    params = tuple(value for _, values in attributes for value in values)
+    return where, params
+
+def show_filter(imdbid, seasonnum, episode=None, attributes=()):
+    # Use parameterized query to prevent SQL injection
+    where = "mtype=? AND imdb_id=? AND season=?"
+    params = (MTYPE_SHOW, imdbid, seasonnum)
+    if episode is not None:
+        # Multi-episode releases match any episode of their range
+        where += " AND episode_start<=? AND episode_end>=?"
+        params += (episode, episode)
+    attribute_where, attribute_values = attribute_filter(attributes)
+    return where + attribute_where, params + attribute_values
+
+def movie_filter(imdbid, attributes=()):
+    attribute_where, attribute_values = attribute_filter(attributes)
+    return "mtype=? AND imdb_id=?" + attribute_where, (MTYPE_MOVIE, imdbid, *attribute_values)
+
+def query_shows_with_imdb(imdbid, seasonnum, episode=None, offset=0, limit=-1, attributes=()):
+    """
+    Queries the releases of a show season, or of one of its episodes.
+
+    :return: The cursor of the results.
+    """
+    return query_releases(*show_filter(imdbid, seasonnum, episode, attributes), offset, limit)
+
+def query_movies_with_imdb(imdbid, offset=0, limit=-1, attributes=()):
+    """
+    Queries the releases of a movie.
+
+    :return: The cursor of the results.
+    """
+    return query_releases(*movie_filter(imdbid, attributes), offset, limit)
+
+# Newest first in the order releases were ingested in, which the RSS
+# cursors follow
+RSS_ORDER = "ingested_at DESC, rowid DESC"
+# Oldest first, for polls from a cursor or timestamp, so a client following
+# the cursor of each page doesn't skip anything
+RSS_POLL_ORDER = "ingested_at, rowid"
+# Releases of polls carry their rowid, to build the cursor of the last one
+RSS_POLL_COLUMNS = "*, rowid AS rss_rowid"
+
+def rss_filter(mtypes, since=None, after=None, attributes=()):
+    """
+    Builds the filter of the RSS feed.
+
+    :param mtypes: The media types to include.
+    :param since: Only include releases ingested after this time, if set.
+    :param after: Only include releases ingested after this
+                  (ingested_at, rowid) cursor, if set.
+    :param attributes: Pairs of (attribute column, accepted values).
+    :return: A tuple of (where, params).
+    """
+    if set(mtypes) == {MTYPE_MOVIE, MTYPE_SHOW}:
+        # Every release, read in order from the ingested_at index
+        where, params = "1", ()
+    else:
+        where = f"mtype IN ({', '.join('?' * len(mtypes))})" if mtypes else "0"
+        params = tuple(mtypes)
+    if since is not None:
+        where += " AND ingested_at > ?"
+        params += (since,)
+    if after is not None:
+        where += " AND (ingested_at, rowid) > (?, ?)"
+        params += after
+    attribute_where, attribute_values = attribute_filter(attributes)
+    return where + attribute_where, params + attribute_values
+
+def newest_rss_cursor(where, params):
+    """
+    Returns the cursor of the newest release matching an RSS filter, or
+    None if there is none.
+    """
+    query = (f"SELECT ingested_at, rowid FROM {table_name} WHERE {where} AND ingested_at IS NOT NULL "
+             f"AND {unique_content(table_name)} ORDER BY {RSS_ORDER} LIMIT 1")
+    row = execute("rss_cursor", query, params).fetchone()
+    return f"{row[0]}-{row[1]}" if row else None
+
+def has_releases(mtype):
+    """Returns whether there is any release of the given media type."""
+    query = f"SELECT EXISTS (SELECT 1 FROM {table_name} WHERE mtype=?)"
+    return bool(execute("has_releases", query, (mtype,)).fetchone()[0])
+
+def query_random(mtype):
+    """
+    Queries a random release of the given media type.
+
+    :return: The cursor of the result.
+    """
+    query = f"SELECT * FROM {table_name} WHERE mtype=? ORDER BY RANDOM() LIMIT 1"
+    app.logger.debug("Executing query %s", query)
+    return execute("random", query, (mtype,))
+
 @app.route("/search/shows/<imdbid>/<seasonnum>")
 def search_shows_with_imdb(imdbid, seasonnum):
     """
@@ -69,14 +383,9 @@ def search_shows_with_imdb(imdbid, seasonnum):
     :return: A dictionary containing the search results.
     """
     app.logger.info('New show search request for %s, Season %s', imdbid, seasonnum)
-    with sqlite3.connect(db_path) as conn:
-        cursor = conn.cursor()
-        # Use parameterized query to prevent SQL injection
-        query = f"SELECT * FROM {table_name} WHERE mtype=? AND imdb_id=? AND season=?"
-        app.logger.debug("Executing query %s", query)
-        cursor.execute(query, (MTYPE_SHOW, imdbid, seasonnum))
-        rows = cursor.fetchall()
-        return {"results": rows_to_dicts(cursor, rows)}
+    cursor = query_shows_with_imdb(imdbid, seasonnum)
+    rows = fetch_all(cursor)
+    return {"results": rows_to_dicts(cursor, rows)}
 
 @app.route("/search/movies/<imdbid>")
 def search_movies_with_imdb(imdbid):
@@ -87,14 +396,50 @@ def search_movies_with_imdb(imdbid):
     :return: A dictionary containing the search results.
     """
     app.logger.info('New movie search request for %s', imdbid)
-    with sqlite3.connect(db_path) as conn:
-        cursor = conn.cursor()
-        # Use parameterized query to prevent SQL injection
-        query = f"SELECT * FROM {table_name} WHERE mtype=? AND imdb_id=?"
-        app.logger.debug("Executing query %s", query)
-        cursor.execute(query, (MTYPE_MOVIE, imdbid))
-        rows = cursor.fetchall()
-        return {"results": rows_to_dicts(cursor, rows)}
+    cursor = query_movies_with_imdb(imdbid)
+    rows = fetch_all(cursor)
+    return {"results": rows_to_dicts(cursor, rows)}
+
+def search_titles(mtype, title, offset=0, limit=SEARCH_LIMIT, attributes=()):
+    """
+    Runs a ranked full-text search over the TMDB names and release names.
+
+    Every word of the title matches as a prefix, and results are returned
+    best first.
+
+    :param mtype: The media type to search.
+    :param title: The title to search for.
+    :param offset: The number of results to skip.
+    :param limit: The maximum number of results.
+    :param attributes: Pairs of (attribute column, accepted values).
+    :return: The cursor of the search results.
+    """
+    match = fts_query(title)
+    if match is None:
+        return execute("titles", f"SELECT * FROM {table_name} WHERE 0")
+    attribute_where, attribute_values = attribute_filter(attributes, 'r')
+    # Use parameterized query to prevent SQL injection
+    query = (f"SELECT r.* FROM {fts_table_name} CROSS JOIN {table_name} r ON r.rowid = {fts_table_name}.rowid "
+             f"WHERE {fts_table_name} MATCH ? AND r.mtype=?{attribute_where} AND {unique_content('r')} "
+             f"ORDER BY bm25({fts_table_name}, 10.0, 5.0, 1.0) LIMIT ? OFFSET ?")
+    app.logger.debug("Executing query %s with %s", query, match)
+    return execute("titles", query, (match, mtype, *attribute_values, limit, offset))
+
+def count_titles(mtype, title, attributes=()):
+    """
+    Counts the results of a full-text title search.
+
+    :return: The number of results.
+    """
+    match = fts_query(title)
+    if match is None:
+        return 0
+    attribute_where, attribute_values = attribute_filter(attributes, 'r')
+    # CROSS JOIN keeps the FTS table as the outer loop, otherwise the planner
+    # may scan releases and evaluate the MATCH once per row
+    query = (f"SELECT COUNT(*) FROM {fts_table_name} CROSS JOIN {table_name} r ON r.rowid = {fts_table_name}.rowid "
+             f"WHERE {fts_table_name} MATCH ? AND r.mtype=?{attribute_where} AND {unique_content('r')}")
+    return execute("count_titles", query, (match, mtype, *attribute_values)).fetchone()[0]
 
 # This is needed to make prowlarr tests happy
 @app.route("/search/shows/title/")
@@ -105,13 +450,9 @@ def search_shows_with_title_test():
     :return: A dictionary containing a random show.
     """
     app.logger.info('New show search request for testing')
-    with sqlite3.connect(db_path) as conn:
-        cursor = conn.cursor()
-        query = f"SELECT * FROM {table_name} WHERE mtype='{MTYPE_SHOW}' ORDER BY RANDOM() LIMIT 1;"
-        app.logger.debug("Executing query %s", query)
-        cursor.execute(query)
-        rows = cursor.fetchall()
-        return {"results": rows_to_dicts(cursor, rows)}
+    cursor = query_random(MTYPE_SHOW)
+    rows = fetch_all(cursor)
+    return {"results": rows_to_dicts(cursor, rows)}
 
 # This is needed to make prowlarr tests happy
 @app.route("/search/movies/title/")
@@ -122,13 +463,9 @@ def search_movies_with_title_test():
     :return: A dictionary containing a random movie.
     """
     app.logger.info('New movie search request for testing')
-    with sqlite3.connect(db_path) as conn:
-        cursor = conn.cursor()
-        query = f"SELECT * FROM {table_name} WHERE mtype='{MTYPE_MOVIE}' ORDER BY RANDOM() LIMIT 1;"
-        app.logger.debug("Executing query %s", query)
-        cursor.execute(query)
-        rows = cursor.fetchall()
-        return {"results": rows_to_dicts(cursor, rows)}
+    cursor = query_random(MTYPE_MOVIE)
+    rows = fetch_all(cursor)
+    return {"results": rows_to_dicts(cursor, rows)}
 
 @app.route("/search/shows/title/<title>")
 def search_shows_with_title(title):
@@ -139,14 +476,9 @@ def search_shows_with_title(title):
     :return: A dictionary containing the search results.
     """
     app.logger.info('New show search request for %s', title)
-    with sqlite3.connect(db_path) as conn:
-        cursor = conn.cursor()
-        # Use parameterized query to prevent SQL injection
-        query = f"SELECT * FROM {table_name} WHERE mtype=? AND lower(tmdb_name)=lower(?)"
-        app.logger.debug("Executing query %s", query)
-        cursor.execute(query, (MTYPE_SHOW, title))
-        rows = cursor.fetchall()
-        return {"results": rows_to_dicts(cursor, rows)}
+    cursor = search_titles(MTYPE_SHOW, title)
+    rows = fetch_all(cursor)
+    return {"results": rows_to_dicts(cursor, rows)}
 
 @app.route("/search/movies/title/<title>")
 def search_movies_with_title(title):
@@ -157,14 +489,9 @@ def search_movies_with_title(title):
     :return: A dictionary containing the search results.
     """
     app.logger.info('New movie search request for %s', title)
-    with sqlite3.connect(db_path) as conn:
-        cursor = conn.cursor()
-        # Use parameterized query to prevent SQL injection
-        query = f"SELECT * FROM {table_name} WHERE mtype=? AND lower(tmdb_name)=lower(?)"
-        app.logger.debug("Executing query %s", query)
-        cursor.execute(query, (MTYPE_MOVIE, title))
-        rows = cursor.fetchall()
-        return {"results": rows_to_dicts(cursor, rows)}
+    cursor = search_titles(MTYPE_MOVIE, title)
+    rows = fetch_all(cursor)
+    return {"results": rows_to_dicts(cursor, rows)}
 
 @app.route("/api")
 def newznab_api():
@@ -175,53 +502,251 @@ def newznab_api():
     """
     function = request.args.get('t')
     if function == "caps":
-        return Response("""<caps>
-        <server appversion="1.0.0" version="0.1" title="UDIndexer" strapline="" />
-        <limits max="100" default="100"/>
-        <registration available="no" open="no"/>
-        <searching>
-            <search available="yes" supportedParams="q"/>
-            <tv-search available="yes" supportedParams="q,imdbid,season,ep"/>
-            <movie-search available="yes" supportedParams="q,imdbid"/>
-        </searching>
-        <categories>
-            <category id="2000" name="Movies"></category>
-            <category id="5000" name="TV"></category>
-        </categories>
-        <genres>
-            <genre id="2" categoryid="2000" name="All"/>
-            <genre id="5" categoryid="5000" name="All"/>
-        </genres>
-        </caps>""", mimetype='application/xml')
+        return Response(CAPS_XML, mimetype='application/xml')
+
+    chunks = api_chunks(request.args)
+    if chunks is None:
+        abort(400)
+    return Response(chunks, mimetype='application/xml')
+
+@app.route("/cache/stats")
+def cache_stats():
+    """
+    Reports the hit/miss statistics of the /api response cache.
+
+    :return: A JSON object with the cache counters and size.
+    """
+    return response_cache.info()
+
+def normalize_imdb_id(imdb_id):
+    if imdb_id and not imdb_id.startswith("tt"):
+        imdb_id = "tt" + imdb_id
+    return imdb_id
+
+def search_categories(cats):
+    """Returns the category a search is for, or None if it isn't supported."""
+    if cats and '2000' in cats:
+        return 2000
+    if cats and '5000' in cats:
+        return 5000
+    return None
+
+def episode_param(args):
+    """
+    Reads the episode number of a tvsearch request.
+
+    :return: The episode number, or None to search the whole season.
+    """
+    try:
+        return int(args.get('ep'))
+    except (TypeError, ValueError):
+        return None
+
+def page_params(args):
+    """
+    Reads the paging parameters of an /api request, clamped to the limits
+    advertised by caps.
+
+    :return: A tuple of (offset, limit).
+    """
+    try:
+        offset = max(0, int(args.get('offset', 0)))
+    except ValueError:
+        offset = 0
+    try:
+        limit = min(API_MAX_LIMIT, max(0, int(args.get('limit', API_DEFAULT_LIMIT))))
+    except ValueError:
+        limit = API_DEFAULT_LIMIT
+    return offset, limit
+
+def rss_params(args):
+    """
+    Reads the parameters of an RSS request: the categories in `cat`, a
+    Unix timestamp in `since` and a cursor returned by a previous response
+    in `cursor`.
 
+    :return: A tuple of (media types, since, after cursor).
+    """
+    cats = (args.get('cat') or "").split(',')
+    mtypes = [mtype for cat, mtype in (('2000', MTYPE_MOVIE), ('5000', MTYPE_SHOW))
+              if cat in cats] if args.get('cat') else [MTYPE_MOVIE, MTYPE_SHOW]
+    try:
+        since = int(args.get('since'))
+    except (TypeError, ValueError):
+        since = None
+    try:
+        ingested_at, rowid = (int(part) for part in args.get('cursor', '').split('-'))
+        after = (ingested_at, rowid)
+    except ValueError:
+        after = None
+    return mtypes, since, after
+
+def attribute_params(args):
+    """
+    Reads the attribute filters of an /api request, each parameter of
+    ATTRIBUTE_PARAMS taking a comma separated list of accepted values,
+    compared case-insensitively.
+
+    :return: A tuple of (attribute column, accepted values) pairs, with the
+             values folded and sorted so equivalent requests compare equal.
+    """
+    attributes = []
+    for param, column in ATTRIBUTE_PARAMS.items():
+        values = {snapshot.nocase(value.strip()) for value in (args.get(param) or "").split(',')}
+        values.discard("")
+        if values:
+            attributes.append((column, tuple(sorted(values))))
+    return tuple(attributes)
+
+def cache_key(args):
+    """
+    Builds the response cache key of an /api request from the parameters
+    that affect its result.
+
+    :return: The key, or None if the response must not be cached.
+    """
+    function = args.get('t')
+    page = page_params(args)
+    attributes = attribute_params(args)
     if function == "tvsearch":
-        imdb_id = request.args.get('imdbid')
-        if not imdb_id.startswith("tt"):
-            imdb_id = "tt" + imdb_id
-        season = request.args.get('season')
-        results = search_shows_with_imdb(imdb_id, season)
-        return Response(construct_xml(results['results'], 5000), mimetype='application/xml')
+        return (function, normalize_imdb_id(args.get('imdbid')), args.get('season'),
+                episode_param(args), attributes, page)
+    if function == "movie":
+        return (function, normalize_imdb_id(args.get('imdbid')), attributes, page)
+    if function == "search":
+        q = " ".join((args.get('q') or "").lower().split())
+        # Searches without a query return random releases
+        if not q:
+            return None
+        return (function, q, search_categories(args.get('cat')), attributes, page)
+    if function == "rss":
+        mtypes, since, after = rss_params(args)
+        return (function, tuple(mtypes), since, after, attributes, page)
+    return None
+
+def current_generation():
+    """
+    Returns the catalog generation bumped by the producer on every write, or
+    None if the DB predates it.
+    """
+    try:
+        return execute("generation", f"SELECT generation FROM {STATE_TABLE_NAME} WHERE id = 0").fetchone()[0]
+    except (sqlite3.Error, TypeError):
+        return None
+
+def api_chunks(args):
+    """
+    Answers a Newznab search from the response cache, or renders it and
+    caches the result once it has been fully rendered.
+
+    :param args: The query parameters of the request.
+    :return: An iterable of XML chunks, or None if the function isn't supported.
+    """
+    key = cache_key(args)
+    generation = current_generation() if key is not None else None
+    if generation is not None:
+        body = response_cache.get(key, generation)
+        if body is not None:
+            return [body]
+
+    chunks = render_api(args, generation)
+    if chunks is None:
+        return None
+    if generation is not None:
+        chunks = response_cache.wrap(key, generation, chunks)
+    return chunks
+
+def snapshot_search(generation, mtype, imdb_id, season=None, episode=None, offset=0, limit=-1, attributes=()):
+    """
+    Looks up a show season or a movie in the catalog snapshot.
+
+    :param generation: The current catalog generation, the snapshot is only
+                       used if it was built from it.
+    :return: A tuple of (cursor, total), or None if there is no up to date
+             snapshot.
+    """
+    current = catalog_snapshot.get(generation) if catalog_snapshot is not None else None
+    if current is None:
+        return None
+    with SNAPSHOT_SECONDS.time():
+        total, rows = current.search(mtype, imdb_id, season, episode, offset, limit, attributes)
+    return snapshot.SnapshotCursor(rows), total
+
+def render_api(args, generation=None):
+    """
+    Runs a Newznab search and renders its results.
+
+    IMDb searches are answered from the catalog snapshot when it is up to
+    date with the DB, and from the DB otherwise.
+
+    :param args: The query parameters of the request.
+    :param generation: The current catalog generation, if known.
+    :return: A generator of XML chunks, or None if the function isn't supported.
+    """
+    function = args.get('t')
+    offset, limit = page_params(args)
+    attributes = attribute_params(args)
+
+    if function == "tvsearch":
+        imdb_id = normalize_imdb_id(args.get('imdbid'))
+        season = args.get('season')
+        episode = episode_param(args)
+        app.logger.info('New show search request for %s, Season %s, Episode %s',
+                        imdb_id, season, episode)
+        found = snapshot_search(generation, MTYPE_SHOW, imdb_id, season, episode, offset, limit, attributes)
+        if found is None:
+            total = count_releases(*show_filter(imdb_id, season, episode, attributes))
+            found = query_shows_with_imdb(imdb_id, season, episode, offset, limit, attributes), total
+        return construct_xml(found[0], 5000, offset, found[1])
 
     if function == "movie":
-        imdb_id = request.args.get('imdbid')
-        if not imdb_id.startswith("tt"):
-            imdb_id = "tt" + imdb_id
-        results = search_movies_with_imdb(imdb_id)
-        return Response(construct_xml(results['results'], 2000), mimetype='application/xml')
+        imdb_id = normalize_imdb_id(args.get('imdbid'))
+        app.logger.info('New movie search request for %s', imdb_id)
+        found = snapshot_search(generation, MTYPE_MOVIE, imdb_id, offset=offset, limit=limit,
+                                attributes=attributes)
+        if found is None:
+            total = count_releases(*movie_filter(imdb_id, attributes))
+            found = query_movies_with_imdb(imdb_id, offset, limit, attributes), total
+        return construct_xml(found[0], 2000, offset, found[1])
 
     if function == "search":
-        q = request.args.get('q')
-        cats = request.args.get('cat')
-        if cats and '2000' in cats:
-            if q:
-                results = search_movies_with_title(q)
-                return Response(construct_xml(results['results'], 2000), mimetype='application/xml')
-            return Response(construct_xml(search_movies_with_title_test()['results'], 2000), mimetype='application/xml')
-        if cats and '5000' in cats:
-            if q:
-                results = search_shows_with_title(q)
-                return Response(construct_xml(results['results'], 5000), mimetype='application/xml')
-            return Response(construct_xml(search_shows_with_title_test()['results'], 5000), mimetype='application/xml')
+        q = args.get('q')
+        cat = search_categories(args.get('cat'))
+        mtype = {2000: MTYPE_MOVIE, 5000: MTYPE_SHOW}.get(cat)
+        if mtype is None:
+            return None
+        app.logger.info('New %s search request for %s', mtype, q)
+        if q:
+            total = count_titles(mtype, q, attributes)
+            cursor = search_titles(mtype, q, offset, limit, attributes)
+            return construct_xml(cursor, cat, offset, total)
+        # Searches without a query return one random release
+        cursor = query_random(mtype)
+        return construct_xml(cursor, cat, 0, int(has_releases(mtype)))
+
+    if function == "rss":
+        mtypes, since, after = rss_params(args)
+        app.logger.info('New RSS request for %s since %s, after %s', mtypes, since, after)
+        where, params = rss_filter(mtypes, since, after, attributes)
+        if since is None and after is None:
+            # Without a starting point the feed only goes RSS_MAX_ITEMS deep,
+            # so its cost doesn't grow with the catalog. It is read newest
+            # first, and its cursor is the newest release.
+            limit = max(0, min(limit, RSS_MAX_ITEMS - offset))
+            total = count_releases(where, params, RSS_MAX_ITEMS, name="count_rss")
+            next_cursor = newest_rss_cursor(where, params)
+            cursor = query_releases(where, params, offset, limit, RSS_ORDER, name="rss")
+        else:
+            # Polls are read oldest first, and their cursor is that of the
+            # last release of the page, or the client's own when nothing is
+            # newer
+            total = count_releases(where, params, name="count_rss")
+            next_cursor = args.get('cursor')
+            cursor = query_releases(where, params, offset, limit, RSS_POLL_ORDER, name="rss",
+                                    columns=RSS_POLL_COLUMNS)
+        return construct_xml(cursor, None, offset, total, next_cursor)
+
+    return None
 
 def rows_to_dicts(cursor, rows):
     """
@@ -231,12 +756,13 @@ def rows_to_dicts(cursor, rows):
     :param rows: The database rows.
     :return: A list of dictionaries.
     """
-    column_names = [desc[0] for desc in cursor.description]
-    data = []
-    for row in rows:
-        # Zip column names and row values to create a dictionary
-        data.append(dict(zip(column_names, row)))
-    return data
+    with ROW_CONVERSION_SECONDS.time():
+        column_names = [desc[0] for desc in cursor.description]
+        data = []
+        for row in rows:
+            # Zip column names and row values to create a dictionary
+            data.append(dict(zip(column_names, row)))
+        return data
 
 def fake_dt():
     """
@@ -248,35 +774,100 @@ def fake_dt():
     one_hour_ago = now - timedelta(hours=1)
     return one_hour_ago.strftime('%a, %d %b %Y %H:%M:%S %z')
 
-def construct_xml(rows_dicts, cat):
+def construct_xml(cursor, cat, offset, total, next_cursor=None):
     """
-    Constructs an XML string from the given data.
-
-    :param rows_dicts: A list of dictionaries containing the data.
-    :param cat: The category ID.
-    :return: An XML string.
+    Renders the XML response for the rows of a cursor.
+
+    The rows are read straight from the cursor and the XML is yielded in
+    chunks, so it can be streamed without holding the whole result set.
+
+    :param cursor: The database cursor of the results.
+    :param cat: The category ID, or None to derive it from the media type of
+                each row.
+    :param offset: The offset of the first row in the full results.
+    :param total: The number of rows in the full results.
+    :param next_cursor: The RSS cursor to return to the client, if any. If
+                        the rows carry an rss_rowid column, the cursor of
+                        the last row rendered is returned instead.
+    :return: A generator of XML chunks.
     """
-    pre = """<?xml version="1.0" encoding="UTF-8"?>
+    columns = {desc[0]: i for i, desc in enumerate(cursor.description)}
+    name_idx = columns['name']
+    filename_idx = columns['filename']
+    size_idx = columns['raw_size']
+    season_idx = columns['season']
+    episode_idx = columns['episode']
+    ingested_idx = columns.get('ingested_at')
+    mtype_idx = columns.get('mtype')
+    rowid_idx = columns.get('rss_rowid')
+    # Attributes are only rendered when the rows carry them
+    attribute_idxs = [(attr, columns[column]) for attr, column in ATTRIBUTE_ATTRS if column in columns]
+
+    # Computed once per response rather than once per row. Releases written
+    # in the same batch share their ingest time.
+    fallback_pub_date = fake_dt()
+    pub_dates = {None: fallback_pub_date}
+    download_prefix = escape(f"{base_url}/download/", XML_ATTR_ENTITIES)
+    category_attrs = {c: f'<newznab:attr name="category" value="{c}"/>' for c in (2000, 5000)}
+    yield f"""<?xml version="1.0" encoding="UTF-8"?>
     <rss version="2.0" xmlns:atom="http://www.w3.org/2005/Atom" xmlns:newznab="http://www.newznab.com/DTD/2010/feeds/attributes/" encoding="utf-8">
-    <channel><newznab:response offset="0" total="100"/><newznab:apilimits apiCurrent="0" grabCurrent="0"/>"""
-    post = """</channel></rss>"""
-    items = ""
-    for row in rows_dicts:
-        item_xml = "<item>"
-        item_xml += f"<title>{row['name']}</title>"
-        item_xml += f"<link>{base_url}/download/{row['filename']}</link>"
-        item_xml += f'<enclosure url=\"{base_url}/download/{row["filename"]}\" length=\"{row["raw_size"]}\" type=\"application/x-nzb\"/>'
-        item_xml += f"<pubDate>{fake_dt()}</pubDate>"
-        item_xml += f'<newznab:attr name=\"category\" value=\"{cat}\"/>'
-        item_xml += f'<newznab:attr name=\"size\" value=\"{row["raw_size"]}\"/>'
-        item_xml += f'<newznab:attr name=\"files\" value=\"1\"/>'
-        item_xml += f'<newznab:attr name=\"title\" value=\"\"/>'
-        if cat == 5000:
-            item_xml += f'<newznab:attr name=\"season\" value=\"{row["season"]}\"/>'
-            item_xml += f'<newznab:attr name=\"episode\" value=\"{row["episode"]}\"/>'
-        item_xml += "</item>"
-        items += item_xml
-    return f"{pre}{items}{post}"
+    <channel><newznab:response offset="{offset}" total="{total}"/><newznab:apilimits apiCurrent="0" grabCurrent="0"/>"""
+
+    # Rows are fetched lazily, so fetches are timed apart from rendering, and
+    # the time spent waiting on the client between chunks isn't counted
+    fetch_seconds = 0.0
+    render_seconds = 0.0
+    last_row = None
+    try:
+        while True:
+            started = time.perf_counter()
+            rows = cursor.fetchmany(XML_CHUNK_ROWS)
+            fetched = time.perf_counter()
+            fetch_seconds += fetched - started
+            if not rows:
+                break
+            chunk = []
+            for row in rows:
+                url = download_prefix + escape(quote(row[filename_idx]), XML_ATTR_ENTITIES)
+                size = row[size_idx]
+                ingested_at = row[ingested_idx] if ingested_idx is not None else None
+                pub_date = pub_dates.get(ingested_at)
+                if pub_date is None:
+                    pub_date = pub_dates[ingested_at] = formatdate(ingested_at, usegmt=True)
+                row_cat = cat
+                if row_cat is None:
+                    row_cat = 5000 if row[mtype_idx] == MTYPE_SHOW else 2000
+                chunk.append(
+                    f'<item><title>{escape(str(row[name_idx]))}</title>'
+                    f'<link>{url}</link>'
+                    f'<enclosure url="{url}" length="{size}" type="application/x-nzb"/>'
+                    f'<pubDate>{pub_date}</pubDate>'
+                    f'{category_attrs[row_cat]}'
+                    f'<newznab:attr name="size" value="{size}"/>'
+                    f'<newznab:attr name="files" value="1"/>'
+                    f'<newznab:attr name="title" value=""/>')
+                for attr, idx in attribute_idxs:
+                    if row[idx] is not None:
+                        chunk.append(f'<newznab:attr name="{attr}" value="{escape(row[idx], XML_ATTR_ENTITIES)}"/>')
+                if row_cat == 5000:
+                    chunk.append(
+                        f'<newznab:attr name="season" value="{row[season_idx]}"/>'
+                        f'<newznab:attr name="episode" value="{escape(str(row[episode_idx]), XML_ATTR_ENTITIES)}"/>')
+                chunk.append("</item>")
+            last_row = row
+            chunk = "".join(chunk)
+            render_seconds += time.perf_counter() - fetched
+            yield chunk
+    finally:
+        SQL_SECONDS.observe(fetch_seconds, query="fetch")
+        RENDER_SECONDS.observe(render_seconds)
+
+    # The cursor comes after the items, as it may be that of the last one
+    if rowid_idx is not None and last_row is not None:
+        next_cursor = f"{last_row[ingested_idx]}-{last_row[rowid_idx]}"
+    if next_cursor is not None:
+        yield f'<newznab:cursor value="{escape(next_cursor, XML_ATTR_ENTITIES)}"/>'
+    yield "</channel></rss>"
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=7990)
\ No newline at end of file
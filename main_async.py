@@ -0,0 +1,191 @@
+"""
+Async serving mode of the indexer, exposing the same routes as main.py on
+aiohttp.
+
+DB queries and rendering run on a bounded thread pool, and NZB downloads are
+streamed by aiohttp without blocking the event loop, so a slow read from the
+NZB mount doesn't hold up concurrent searches.
+
+Run it with:
+    gunicorn main_async:app --worker-class aiohttp.GunicornWebWorker --bind=0.0.0.0:7990
+"""
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+
+import delivery
+import main
+import metrics
+
+# Threads running DB queries, each with its own read-only connection
+INDEXER_DB_WORKERS = int(os.environ.get('INDEXER_DB_WORKERS', 8))
+
+logger = logging.getLogger('gunicorn.error')
+
+executor = ThreadPoolExecutor(max_workers=INDEXER_DB_WORKERS, thread_name_prefix='indexer-db')
+routes = web.RouteTableDef()
+
+
+async def run_db(func, *args):
+    """Runs a blocking DB function on the executor."""
+    return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+
+def _fetch_dicts(query, *args):
+    cursor = query(*args)
+    return {"results": main.rows_to_dicts(cursor, cursor.fetchall())}
+
+
+def _locate_nzb(filename, accept_encoding):
+    full_path = main.find_nzb_path(filename)
+    if full_path is None:
+        return None, None
+    return full_path, delivery.select_representation(full_path, accept_encoding)
+
+
+def _render_api(args):
+    # The cursor a response is rendered from can only be used by the thread
+    # that opened it, so responses are rendered in full on the executor
+    chunks = main.api_chunks(args)
+    if chunks is None:
+        return None
+    return b"".join(chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+                    for chunk in chunks)
+
+
+@web.middleware
+async def time_requests(request, handler):
+    """Observes the time to produce each response in the request metrics."""
+    started = time.perf_counter()
+    try:
+        return await handler(request)
+    finally:
+        resource = request.match_info.route.resource
+        route = resource.canonical if resource is not None else "unmatched"
+        main.REQUEST_SECONDS.observe(time.perf_counter() - started, route=route,
+                                     function=main.api_function_label(route, request.query.get('t')))
+
+
+@routes.get('/download/{filename}')
+async def download_nzb(request):
+    """
+    Downloads an NZB file.
+
+    :return: The NZB file if found, otherwise a 404 error.
+    """
+    filename = request.match_info['filename']
+    logger.info('New download request for %s', filename)
+    full_path, representation = await run_db(
+        _locate_nzb, filename, request.headers.get('Accept-Encoding'))
+    if full_path is None:
+        raise web.HTTPNotFound()
+    logger.debug("Found %s at path %s", filename, full_path)
+    path, _, encoding = representation
+    headers = {
+        'Content-Disposition': f'attachment; filename="{os.path.basename(full_path)}"',
+        'Content-Type': 'application/x-nzb',
+        'Vary': 'Accept-Encoding',
+    }
+    if encoding is not None:
+        headers['Content-Encoding'] = encoding
+    # FileResponse sends the file with sendfile, sets the same validators as
+    # delivery.etag and answers conditional requests with 304
+    return web.FileResponse(path, headers=headers)
+
+
+# Registered before the IMDb routes, which would otherwise match them too
+@routes.get('/search/shows/title/')
+async def search_shows_with_title_test(request):
+    """Searches for a random show, needed to make prowlarr tests happy."""
+    logger.info('New show search request for testing')
+    return web.json_response(await run_db(_fetch_dicts, main.query_random, main.MTYPE_SHOW))
+
+
+@routes.get('/search/movies/title/')
+async def search_movies_with_title_test(request):
+    """Searches for a random movie, needed to make prowlarr tests happy."""
+    logger.info('New movie search request for testing')
+    return web.json_response(await run_db(_fetch_dicts, main.query_random, main.MTYPE_MOVIE))
+
+
+@routes.get('/search/shows/title/{title}')
+async def search_shows_with_title(request):
+    """Searches for shows with the given title."""
+    title = request.match_info['title']
+    logger.info('New show search request for %s', title)
+    return web.json_response(
+        await run_db(_fetch_dicts, main.search_titles, main.MTYPE_SHOW, title))
+
+
+@routes.get('/search/movies/title/{title}')
+async def search_movies_with_title(request):
+    """Searches for movies with the given title."""
+    title = request.match_info['title']
+    logger.info('New movie search request for %s', title)
+    return web.json_response(
+        await run_db(_fetch_dicts, main.search_titles, main.MTYPE_MOVIE, title))
+
+
+@routes.get('/search/shows/{imdbid}/{seasonnum}')
+async def search_shows_with_imdb(request):
+    """Searches for shows with the given IMDb ID and season number."""
+    imdbid = request.match_info['imdbid']
+    seasonnum = request.match_info['seasonnum']
+    logger.info('New show search request for %s, Season %s', imdbid, seasonnum)
+    return web.json_response(
+        await run_db(_fetch_dicts, main.query_shows_with_imdb, imdbid, seasonnum))
+
+
+@routes.get('/search/movies/{imdbid}')
+async def search_movies_with_imdb(request):
+    """Searches for movies with the given IMDb ID."""
+    imdbid = request.match_info['imdbid']
+    logger.info('New movie search request for %s', imdbid)
+    return web.json_response(
+        await run_db(_fetch_dicts, main.query_movies_with_imdb, imdbid))
+
+
+@routes.get('/api')
+async def newznab_api(request):
+    """
+    Handles Newznab API requests.
+
+    :return: An XML response containing the requested data.
+    """
+    if request.query.get('t') == "caps":
+        return web.Response(text=main.CAPS_XML, content_type='application/xml')
+
+    body = await run_db(_render_api, request.query)
+    if body is None:
+        raise web.HTTPBadRequest()
+    return web.Response(body=body, content_type='application/xml', charset='utf-8')
+
+
+@routes.get('/metrics')
+async def serve_metrics(request):
+    """Serves the indexer metrics in the Prometheus text format."""
+    body = metrics.REGISTRY.render().encode('utf-8')
+    return web.Response(body=body, headers={'Content-Type': metrics.CONTENT_TYPE})
+
+
+@routes.get('/cache/stats')
+async def cache_stats(request):
+    """Reports the hit/miss statistics of the /api response cache."""
+    return web.json_response(main.response_cache.info())
+
+
+async def shutdown_executor(app):
+    executor.shutdown(wait=False)
+
+
+app = web.Application(middlewares=[time_requests])
+app.add_routes(routes)
+app.on_cleanup.append(shutdown_executor)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    web.run_app(app, port=7990)
@@ -0,0 +1,94 @@
+import hashlib
+import os
+import re
+import xml.etree.ElementTree as ET
+from xml.parsers import expat
+
+# Password embedded in an NZB filename, e.g. "Name{{secret}}.nzb"
+PASSWORD_RE = re.compile("{{(.+)?}}")
+# Whitespace and angle brackets around message-ids
+MESSAGE_ID_STRIP = " \t\r\n<>"
+# Modulus of the sum of message-id hashes making up a fingerprint
+FINGERPRINT_MODULUS = 2 ** 128
+
+
+class _NZBHandler:
+    """SAX-style handler accumulating the metadata of a single NZB."""
+
+    def __init__(self, fingerprint=True):
+        self.subject = None
+        self.raw_size = 0
+        # Sum of the hashes of the message-ids, and how many were hashed
+        self.fingerprint_sum = 0
+        self.message_ids = 0
+        self.in_segment = False
+        self.fingerprint_ids = fingerprint
+
+    def start_element(self, name, attrs):
+        # Namespaced tags arrive as "<uri>}<tag>"
+        tag = name.rsplit('}', 1)[-1]
+        if tag == 'segment':
+            self.raw_size += int(attrs.get('bytes', 0))
+            self.in_segment = self.fingerprint_ids
+        elif tag == 'file' and self.subject is None:
+            self.subject = attrs.get('subject')
+
+    def character_data(self, data):
+        # With buffered text, the message-id arrives right after the start
+        # of its segment in a single call
+        if self.in_segment:
+            self.in_segment = False
+            message_id = data.strip(MESSAGE_ID_STRIP)
+            if message_id:
+                digest = hashlib.blake2b(message_id.encode('utf-8'), digest_size=16).digest()
+                self.fingerprint_sum += int.from_bytes(digest, 'little')
+                self.message_ids += 1
+
+    def fingerprint(self):
+        """
+        Combines the hashes of the message-ids of all segments by summing
+        them, so the fingerprint doesn't depend on the order of the files and
+        segments and is computed in constant memory.
+
+        :return: The fingerprint, or None if the NZB has no segments.
+        """
+        if not self.message_ids:
+            return None
+        return (self.fingerprint_sum % FINGERPRINT_MODULUS).to_bytes(16, 'little').hex()
+
+
+def parse_nzb(filepath, fingerprint=True):
+    """
+    Parses the metadata of an NZB file in a single streaming pass, in
+    constant memory.
+
+    :param filepath: The path of the NZB file.
+    :param fingerprint: Whether to fingerprint the content, which costs a
+                        hash per segment.
+    :return: A dictionary with the filename, the release name derived from
+             the filename, the subject of the first file, the total size
+             of all segments in bytes and the content fingerprint, a hash of
+             the message-ids of all segments which doesn't depend on the
+             filename or the order of the segments, or None if the NZB has
+             no segments or `fingerprint` is False.
+    :raises ET.ParseError: If the NZB is not well-formed XML.
+    """
+    handler = _NZBHandler(fingerprint)
+    parser = expat.ParserCreate(namespace_separator='}')
+    parser.buffer_text = True
+    parser.StartElementHandler = handler.start_element
+    parser.CharacterDataHandler = handler.character_data
+    try:
+        with open(filepath, 'rb') as f:
+            parser.ParseFile(f)
+    except expat.ExpatError as e:
+        raise ET.ParseError(f"{filepath}: {e}") from e
+
+    filename = os.path.basename(filepath)
+    return {
+        'filename': filename,
+        'name': PASSWORD_RE.sub("", filename.replace(".nzb", "")),
+        'subject': handler.subject,
+        'raw_size': handler.raw_size,
+        'fingerprint': handler.fingerprint(),
+    }
@@ -1,14 +1,26 @@
 import asyncio
 import aiohttp
+import json
 import logging
 import os
 import re
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from typing import Dict
 import sqlite3
-import LordNzb
 import PTN
+from watchdog.events import FileSystemEventHandler
+from watchdog.observers import Observer
 
-DATABASE = "nzbs.db"
+import metrics
+import snapshot
+from nzbparser import parse_nzb
+from schema import (ATTRIBUTE_COLUMNS, STATE_TABLE_NAME, TABLE_NAME, bump_generation, episode_range, migrate,
+                    normalize_title, release_attributes)
+from tmdb import TMDBClient
+
+DATABASE = os.path.join(os.environ.get('CONFIG_DIR', '/config'), "nzbs.db")
 conn = sqlite3.connect(DATABASE)
 cursor = conn.cursor()
 
@@ -20,13 +32,62 @@ logging.basicConfig(filename='producer.log',
 MTYPE_SHOW = "show"
 MTYPE_MOVIE = "movie"
 
+# How long TMDB lookups are cached, in seconds. Searches without results are
+# retried sooner as TMDB may have added the title since.
+TMDB_CACHE_TTL = int(os.environ.get('TMDB_CACHE_TTL', 30 * 24 * 3600))
+TMDB_NEGATIVE_CACHE_TTL = int(os.environ.get('TMDB_NEGATIVE_CACHE_TTL', 24 * 3600))
+
+# Ingest pipeline tuning: NZBs enriched from TMDB concurrently, processes
+# parsing NZBs, size of the queues between stages, and how many rows the
+# writer inserts per transaction and how long it waits to fill a batch.
+PRODUCER_CONCURRENCY = int(os.environ.get('PRODUCER_CONCURRENCY', 32))
+PARSE_WORKERS = int(os.environ.get('PARSE_WORKERS', os.cpu_count() or 1))
+PIPELINE_QUEUE_SIZE = int(os.environ.get('PIPELINE_QUEUE_SIZE', 1000))
+WRITE_BATCH_SIZE = int(os.environ.get('WRITE_BATCH_SIZE', 500))
+WRITE_BATCH_LINGER = float(os.environ.get('WRITE_BATCH_LINGER', 0.5))
+
+NZBS_DIR = os.environ.get('NZBS_DIR', '.')
+# Threads listing directories of NZBS_DIR concurrently during a scan
+CRAWL_WORKERS = int(os.environ.get('CRAWL_WORKERS', 16))
+# Keep watching NZBS_DIR for new NZBs after the startup scan. Files are
+# ingested once they haven't changed for WATCH_DEBOUNCE seconds.
+PRODUCER_WATCH = os.environ.get('PRODUCER_WATCH', 'true').lower() in ('1', 'true', 'yes')
+WATCH_DEBOUNCE = float(os.environ.get('WATCH_DEBOUNCE', 1.0))
+
+# Compact catalog snapshot mapped by the indexer workers, empty to disable.
+# It is rebuilt after the startup scan, then at most every
+# CATALOG_SNAPSHOT_INTERVAL seconds while the catalog changes.
+CATALOG_SNAPSHOT_PATH = os.environ.get(
+    'CATALOG_SNAPSHOT_PATH', os.path.join(os.environ.get('CONFIG_DIR', '/config'), "catalog.snapshot"))
+CATALOG_SNAPSHOT_INTERVAL = float(os.environ.get('CATALOG_SNAPSHOT_INTERVAL', 30))
+
+# Port serving /metrics and textfile the metrics are written to, both off by default
+PRODUCER_METRICS_PORT = int(os.environ.get('PRODUCER_METRICS_PORT', 0))
+PRODUCER_METRICS_TEXTFILE = os.environ.get('PRODUCER_METRICS_TEXTFILE')
+
+PARSE_SECONDS = metrics.histogram(
+    'producer_nzb_parse_seconds', "Time to parse an NZB and its release name in a worker")
+TMDB_CACHE = metrics.counter(
+    'producer_tmdb_cache_total', "Lookups of the TMDB cache", ['cache', 'result'])
+FILES = metrics.counter(
+    'producer_files_total', "Files that went through the ingest pipeline", ['result'])
+RELEASES_WRITTEN = metrics.counter(
+    'producer_releases_written_total', "Releases inserted or updated in the DB")
+WRITE_SECONDS = metrics.histogram(
+    'producer_write_batch_seconds', "Time to write a batch of releases in one transaction")
+SNAPSHOT_SECONDS = metrics.histogram(
+    'producer_snapshot_build_seconds', "Time to build and publish the catalog snapshot")
+
+# Catalog generation of the last published snapshot
+snapshot_generation = None
+
 class NZB:
     """Represents an NZB file with its metadata."""
 
     def __init__(self,
-                 filename: str,
-                 raw_size: int,
-                 mtype: str,
+                 filename: str = None,
+                 raw_size: int = None,
+                 mtype: str = None,
                  imdb_id: str = None,
                  season: int = None,
                  episode: int = None,
@@ -39,168 +100,770 @@ class NZB:
         self.episode = episode
         self.tmdb_name = tmdb_name
 
-async def fetch_tmdb_data(nzbo, parsed_info):
-    """Fetches data from TMDB API asynchronously."""
+def get_cached_tmdb_search(mtype, title, year):
+    """
+    Looks up a cached TMDB search.
+
+    :return: A (hit, tmdb_id) tuple. tmdb_id is None for a cached search
+             that had no results.
+    """
+    cursor.execute(
+        "SELECT tmdb_id, fetched_at FROM tmdb_search_cache WHERE mtype = ? AND title = ? AND year = ?",
+        (mtype, normalize_title(title), year or 0))
+    row = cursor.fetchone()
+    if row is None:
+        return False, None
+    tmdb_id, fetched_at = row
+    ttl = TMDB_CACHE_TTL if tmdb_id is not None else TMDB_NEGATIVE_CACHE_TTL
+    if time.time() - fetched_at > ttl:
+        return False, None
+    return True, tmdb_id
+
+def set_cached_tmdb_search(mtype, title, year, tmdb_id):
+    cursor.execute(
+        "INSERT OR REPLACE INTO tmdb_search_cache (mtype, title, year, tmdb_id, fetched_at) VALUES (?, ?, ?, ?, ?)",
+        (mtype, normalize_title(title), year or 0, tmdb_id, int(time.time())))
+    conn.commit()
+
+def get_cached_tmdb_details(mtype, tmdb_id):
+    """Looks up cached TMDB details, returning None on a miss."""
+    cursor.execute(
+        "SELECT data, fetched_at FROM tmdb_details_cache WHERE mtype = ? AND tmdb_id = ?",
+        (mtype, tmdb_id))
+    row = cursor.fetchone()
+    if row is None or time.time() - row[1] > TMDB_CACHE_TTL:
+        return None
+    return json.loads(row[0])
+
+def set_cached_tmdb_details(mtype, tmdb_id, details):
+    cursor.execute(
+        "INSERT OR REPLACE INTO tmdb_details_cache (mtype, tmdb_id, data, fetched_at) VALUES (?, ?, ?, ?)",
+        (mtype, tmdb_id, json.dumps(details), int(time.time())))
+    conn.commit()
+
+async def search_tmdb(client, mtype, title):
+    """Searches TMDB, returning the id of the first result or None."""
+    kind = "tv" if mtype == MTYPE_SHOW else "movie"
+    results = await client.search(kind, title)
+    if len(results) > 0:
+        return results[0]['id']
+    return None
+
+async def fetch_tmdb_details(client, mtype, tmdb_id):
+    """Fetches the details of a show or movie, normalized across both."""
+    if mtype == MTYPE_SHOW:
+        data = await client.details("tv", tmdb_id)
+        return {
+            'id': data['id'],
+            'original_name': data['original_name'],
+            'name': data['name'],
+            'release_date': data['first_air_date'],
+            'imdb_id': data['external_ids']['imdb_id'],
+        }
+    data = await client.details("movie", tmdb_id)
+    return {
+        'id': data['id'],
+        'original_name': data['original_title'],
+        'name': data['title'],
+        'release_date': data['release_date'],
+        'imdb_id': data['external_ids']['imdb_id'],
+    }
+
+async def fetch_tmdb_data(client, nzbo, parsed_info):
+    """
+    Fetches data from TMDB API asynchronously.
+
+    Searches and details are cached in the DB, so the API is only called
+    for titles that haven't been looked up within the cache TTL.
+    """
     try:
-        async with aiohttp.ClientSession() as session:
-            if nzbo.mtype == MTYPE_SHOW:
-                # It's a TV show
-                async with session.get(
-                        f"https://api.themoviedb.org/3/search/tv?api_key={os.environ.get('TMDB_KEY')}&query={parsed_info['title']}"
-                ) as response:
-                    response.raise_for_status()
-                    matching_shows = await response.json()
-                    if len(matching_shows['results']) > 0:
-                        show_id = matching_shows['results'][0]['id']
-                        async with session.get(
-                                f"https://api.themoviedb.org/3/tv/{show_id}?api_key={os.environ.get('TMDB_KEY')}&append_to_response=external_ids"
-                        ) as response:
-                            response.raise_for_status()
-                            show = await response.json()
-                            nzbo.tmdb_id = show['id']
-                            nzbo.tmdb_original_name = show['original_name']
-                            nzbo.tmdb_name = show['name']
-                            nzbo.tmdb_release_date = show['first_air_date']
-                            nzbo.tmdb_year = int(
-                                show['first_air_date'].split('-')[0])
-                            nzbo.imdb_id = show['external_ids']['imdb_id']
-            else:
-                # It's a movie
-                async with session.get(
-                        f"https://api.themoviedb.org/3/search/movie?api_key={os.environ.get('TMDB_KEY')}&query={parsed_info['title']}"
-                ) as response:
-                    response.raise_for_status()
-                    matching_movies = await response.json()
-                    if len(matching_movies['results']) > 0:
-                        movie_id = matching_movies['results'][0]['id']
-                        async with session.get(
-                                f"https://api.themoviedb.org/3/movie/{movie_id}?api_key={os.environ.get('TMDB_KEY')}&append_to_response=external_ids"
-                        ) as response:
-                            response.raise_for_status()
-                            movie = await response.json()
-                            nzbo.tmdb_id = movie['id']
-                            nzbo.tmdb_original_name = movie[
-                                'original_title']
-                            nzbo.tmdb_name = movie['title']
-                            nzbo.tmdb_release_date = movie['release_date']
-                            nzbo.tmdb_year = int(
-                                movie['release_date'].split('-')[0])
-                            nzbo.imdb_id = movie['external_ids']['imdb_id']
+        title = parsed_info['title']
+        hit, tmdb_id = get_cached_tmdb_search(nzbo.mtype, title, nzbo.year)
+        TMDB_CACHE.inc(cache="search", result="hit" if hit else "miss")
+        if hit and tmdb_id is None:
+            logging.debug(f"Cached TMDB miss for {title}")
+            return
+        details = get_cached_tmdb_details(nzbo.mtype, tmdb_id) if hit else None
+        if hit:
+            TMDB_CACHE.inc(cache="details", result="miss" if details is None else "hit")
+
+        if details is None:
+            if not hit:
+                tmdb_id = await search_tmdb(client, nzbo.mtype, title)
+                set_cached_tmdb_search(nzbo.mtype, title, nzbo.year, tmdb_id)
+                if tmdb_id is None:
+                    return
+            details = await fetch_tmdb_details(client, nzbo.mtype, tmdb_id)
+            set_cached_tmdb_details(nzbo.mtype, tmdb_id, details)
+
+        nzbo.tmdb_id = details['id']
+        nzbo.tmdb_original_name = details['original_name']
+        nzbo.tmdb_name = details['name']
+        nzbo.tmdb_release_date = details['release_date']
+        nzbo.tmdb_year = int(details['release_date'].split('-')[0])
+        nzbo.imdb_id = details['imdb_id']
     except aiohttp.ClientError as e:
         logging.error(f"Error fetching TMDB data: {e}")
     except Exception as e:
         logging.exception(f"An unexpected error occurred: {e}")
 
-async def process_single_nzb(file_path: str):
-    """Processes a single NZB file asynchronously."""
+def parse_release(file_path: str):
+    """
+    Parses an NZB file and its release name.
+
+    This is CPU-bound and runs in a worker process, so it only returns plain
+    data and never touches the DB.
+
+    :return: A dictionary describing the release, or None if the NZB could
+             not be parsed.
+    """
+    started = time.perf_counter()
     try:
-        with open(file_path, 'rb') as f:
-            nzbo = NZB()
+        nzb_metadata = parse_nzb_metadata(file_path)
+        parsed_info = PTN.parse(nzb_metadata['name'])
+    except Exception as e:
+        logging.exception(
+            f"An unexpected error occurred while parsing {file_path}: {e}")
+        return None
+
+    release = {
+        'path': os.path.abspath(file_path),
+        'filename': nzb_metadata['filename'],
+        'name': nzb_metadata['name'],
+        'raw_size': nzb_metadata['raw_size'],
+        'fingerprint': nzb_metadata['fingerprint'],
+        'title': parsed_info['title'],
+        # Set the year based on the file name
+        'year': parsed_info.get('year', None),
+        **release_attributes(parsed_info),
+    }
+
+    release['mtype'] = MTYPE_MOVIE
+    is_tv = False
+    if 'season' in parsed_info or 'month' in parsed_info or 'episode' in parsed_info:
+        is_tv = True
+        release['mtype'] = MTYPE_SHOW
+
+    # Set season
+    release['season'] = parsed_info.get('season', None)
+    if is_tv and not parsed_info.get('season', None):
+        release['season'] = 1
+
+    # Set episode number
+    if isinstance(parsed_info.get('episode', None), list):
+        release['episode'] = "".join(
+            ["E{:02d}".format(e) for e in parsed_info['episode']])
+    else:
+        release['episode'] = parsed_info.get('episode', None)
+
+    release['parse_seconds'] = time.perf_counter() - started
+    return release
+
+async def enrich_release(client: TMDBClient, release: dict):
+    """Builds the NZB for a parsed release, with its TMDB values set."""
+    nzbo = NZB(filename=release['filename'],
+               raw_size=release['raw_size'],
+               mtype=release['mtype'],
+               season=release['season'],
+               episode=release['episode'])
+    nzbo.name = release['name']
+    nzbo.title = release['title']
+    nzbo.year = release['year']
+    nzbo.path = release['path']
+    nzbo.fingerprint = release['fingerprint']
+    for column in ATTRIBUTE_COLUMNS:
+        setattr(nzbo, column, release[column])
+
+    # Set TMDB values by calling the API
+    nzbo.tmdb_id = None
+    nzbo.tmdb_original_name = None
+    nzbo.tmdb_name = None
+    nzbo.tmdb_release_date = None
+    nzbo.tmdb_year = None
+    nzbo.imdb_id = None
+
+    await fetch_tmdb_data(client, nzbo, release)
+    return nzbo
+
+# Values parsed from an NZB and its name, refreshed on releases that already
+# exist when their NZB is parsed again
+PARSED_COLUMNS = ('fingerprint', 'season', 'episode', *ATTRIBUTE_COLUMNS)
+
+# Values of a known release taken over by re-uploads of its content
+KNOWN_COLUMNS = ('mtype', 'imdb_id', 'tmdb_id', 'tmdb_name', 'tmdb_original_name', 'season', 'episode',
+                 *ATTRIBUTE_COLUMNS)
+
+def known_release(nzbo):
+    """Returns the filename and KNOWN_COLUMNS values of an NZB, as a dictionary."""
+    return {column: getattr(nzbo, column) for column in ('filename', *KNOWN_COLUMNS)}
+
+def parsed_values(release: dict, known: dict = None):
+    """
+    Returns the PARSED_COLUMNS values of a release, those the known release
+    of its content has taken from `known` if it is a re-upload.
+    """
+    return tuple(known[column] if known is not None and column in KNOWN_COLUMNS else release[column]
+                 for column in PARSED_COLUMNS)
+
+def copy_release(release: dict, known: dict):
+    """
+    Builds the NZB for a parsed release whose content is already known under
+    another name, with every KNOWN_COLUMNS value of the known release.
+
+    What the name of the re-upload parses to is ignored. Obfuscated names
+    parse to seasons, episodes and groups that have nothing to do with the
+    content.
+
+    :param known: The KNOWN_COLUMNS values of the known release.
+    """
+    nzbo = NZB(filename=release['filename'],
+               raw_size=release['raw_size'],
+               mtype=known['mtype'],
+               imdb_id=known['imdb_id'],
+               season=known['season'],
+               episode=known['episode'],
+               tmdb_name=known['tmdb_name'])
+    nzbo.name = release['name']
+    nzbo.title = release['title']
+    nzbo.year = release['year']
+    nzbo.path = release['path']
+    nzbo.fingerprint = release['fingerprint']
+    for column in ATTRIBUTE_COLUMNS:
+        setattr(nzbo, column, known[column])
+    nzbo.tmdb_id = known['tmdb_id']
+    nzbo.tmdb_original_name = known['tmdb_original_name']
+    return nzbo
+
+class IngestPipeline:
+    """
+    Staged ingest of NZB files.
+
+    NZBs are parsed in a process pool, enriched from TMDB by a set of async
+    workers and written by a single writer in batches, with bounded queues
+    between the stages. Every file that went through the pipeline is recorded
+    in the manifest, so it isn't parsed again until it changes.
+    """
+
+    def __init__(self, client: TMDBClient):
+        self.client = client
+        self.enrich_queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        self.write_queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        self.stats = {'parsed': 0, 'failed': 0, 'skipped': 0, 'duplicate': 0, 'written': 0}
+        # Fingerprints of releases being enriched or waiting to be written,
+        # which the DB doesn't know yet, resolving to their known_release()
+        # values, or None if they failed
+        self.pending_fingerprints = {}
+
+    async def run(self, files):
+        """
+        Ingests every (path, stat) pair yielded by the async iterable `files`.
+
+        The stat is the (size, mtime_ns, inode) tuple recorded in the
+        manifest. Returns once all of them have been written.
+        """
+        started = time.monotonic()
+        with ProcessPoolExecutor(max_workers=PARSE_WORKERS) as pool:
+            enrichers = [asyncio.ensure_future(self._enrich())
+                         for _ in range(PRODUCER_CONCURRENCY)]
+            writer = asyncio.ensure_future(self._write())
+
+            await self._parse(pool, files)
+            for _ in enrichers:
+                await self.enrich_queue.put(None)
+            await asyncio.gather(*enrichers)
+            await self.write_queue.put(None)
+            await writer
+
+        elapsed = time.monotonic() - started
+        logging.info(
+            f"Ingested {self.stats['parsed']} files in {elapsed:.1f}s "
+            f"({self.stats['parsed'] / max(elapsed, 1e-6):.1f} files/sec): {self.stats}")
 
-            nzb_metadata = parse_nzb_metadata(file_path)
-            parsed_info = PTN.parse(nzb_metadata['name'])
+    def _count(self, result):
+        self.stats[result] += 1
+        FILES.inc(result=result)
 
-            # Set basic metadata
-            nzbo.filename = nzb_metadata['filename']
-            nzbo.name = nzb_metadata['name']
-            nzbo.raw_size = nzb_metadata['raw_size']
-            nzbo.title = parsed_info['title']
+    async def _parse(self, pool, files):
+        loop = asyncio.get_running_loop()
+        # Keeps every worker busy without reading ahead of the queues
+        in_flight = asyncio.Semaphore(PARSE_WORKERS * 2)
+        tasks = set()
 
-            if nzb_exists(nzbo.filename, nzbo.raw_size):
-                logging.debug(
-                    "Already exists in the table.. Skipping")
+        async def parse(file_path, file_stat):
+            try:
+                release = await loop.run_in_executor(pool, parse_release, file_path)
+            finally:
+                in_flight.release()
+            if release is None:
+                self._count('failed')
+                # Recorded anyway so a broken NZB isn't retried until it changes
+                await self.write_queue.put((None, None, file_path, file_stat, None))
                 return
+            self._count('parsed')
+            PARSE_SECONDS.observe(release['parse_seconds'])
+            release['stat'] = file_stat
+            await self.enrich_queue.put(release)
 
-            nzbo.mtype = MTYPE_MOVIE
-            is_tv = False
-            if 'season' in parsed_info or 'month' in parsed_info or 'episode' in parsed_info:
-                is_tv = True
-                nzbo.mtype = MTYPE_SHOW
-
-            # Set the year based on the file name
-            nzbo.year = parsed_info.get('year', None)
-
-            # Set season
-            nzbo.season = parsed_info.get('season', None)
-            if is_tv and not parsed_info.get('season', None):
-                nzbo.season = 1
-
-            # Set episode number
-            if isinstance(parsed_info.get('episode', None), list):
-                nzbo.episode = "".join(
-                    ["E{:02d}".format(e) for e in parsed_info['episode']])
-            else:
-                nzbo.episode = parsed_info.get('episode', None)
-
-            # Set TMDB values by calling the API
-            nzbo.tmdb_id = None
-            nzbo.tmdb_original_name = None
-            nzbo.tmdb_name = None
-            nzbo.tmdb_release_date = None
-            nzbo.tmdb_year = None
-            nzbo.imdb_id = None
-
-            await fetch_tmdb_data(nzbo, parsed_info)
-
-            # Use parameterized query to prevent SQL injection
-            cursor.execute(
-                "INSERT INTO releases (filename, raw_size, mtype, imdb_id, season, tmdb_name) VALUES (?, ?, ?, ?, ?, ?)",
-                (nzbo.filename, nzbo.raw_size, nzbo.mtype, nzbo.imdb_id,
-                 nzbo.season, nzbo.tmdb_name))
-            conn.commit()
+        async for file_path, file_stat in files:
+            await in_flight.acquire()
+            task = asyncio.ensure_future(parse(file_path, file_stat))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks)
+
+    async def _enrich(self):
+        while True:
+            release = await self.enrich_queue.get()
+            if release is None:
+                return
+            nzbo = None
+            parsed = parsed_values(release)
+            try:
+                if nzb_exists(release['filename'], release['raw_size']):
+                    logging.debug(
+                        "Already exists in the table.. Skipping")
+                    self._count('skipped')
+                    # A re-upload keeps the values of the release it copied
+                    known = find_release_by_fingerprint(release['fingerprint'])
+                    if known is not None and known['filename'] != release['filename']:
+                        parsed = parsed_values(release, known)
+                else:
+                    known = await self._find_known(release['fingerprint'])
+                    if known is not None:
+                        # Re-upload of known content, no need to ask TMDB again
+                        logging.debug(f"Content of {release['filename']} already exists, copying it")
+                        self._count('duplicate')
+                        nzbo = copy_release(release, known)
+                    else:
+                        nzbo = await self._enrich_new(release)
+            except Exception as e:
+                logging.exception(
+                    f"An unexpected error occurred while processing {release['path']}: {e}")
+                self._count('failed')
+                continue
+            await self.write_queue.put(
+                (nzbo, release['filename'], release['path'], release['stat'], parsed))
+
+    async def _find_known(self, fingerprint):
+        """
+        Looks up known content by fingerprint, in the DB or among the
+        releases still in the pipeline, waiting for those to be enriched.
 
+        :return: The known_release() values, or None if the content is new.
+        """
+        if fingerprint is None:
+            return None
+        known = find_release_by_fingerprint(fingerprint)
+        # If the release waited for fails, the next one with the same
+        # fingerprint takes over and is waited for instead
+        while known is None and fingerprint in self.pending_fingerprints:
+            known = await self.pending_fingerprints[fingerprint]
+        return known
+
+    async def _enrich_new(self, release):
+        """
+        Enriches a release with new content, letting releases with the same
+        fingerprint that arrive meanwhile wait for it and copy it.
+        """
+        fingerprint = release['fingerprint']
+        if fingerprint is None:
+            return await enrich_release(self.client, release)
+        known = self.pending_fingerprints[fingerprint] = asyncio.get_running_loop().create_future()
+        nzbo = None
+        try:
+            nzbo = await enrich_release(self.client, release)
+            return nzbo
+        finally:
+            known.set_result(known_release(nzbo) if nzbo is not None else None)
+            if nzbo is None:
+                del self.pending_fingerprints[fingerprint]
+
+    async def _write(self):
+        loop = asyncio.get_running_loop()
+        done = False
+        while not done:
+            item = await self.write_queue.get()
+            if item is None:
+                return
+            batch = [item]
+            # Linger briefly so batches fill up while ingest is busy
+            deadline = loop.time() + WRITE_BATCH_LINGER
+            while len(batch) < WRITE_BATCH_SIZE:
+                try:
+                    item = await asyncio.wait_for(self.write_queue.get(),
+                                                  max(0, deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    done = True
+                    break
+                batch.append(item)
+            with WRITE_SECONDS.time():
+                written = write_releases(batch)
+            self.stats['written'] += written
+            RELEASES_WRITTEN.inc(written)
+            # The DB knows the written fingerprints from now on
+            for nzbo, _, _, _, _ in batch:
+                if nzbo is not None and nzbo.fingerprint is not None:
+                    known = self.pending_fingerprints.get(nzbo.fingerprint)
+                    if known is not None and known.done():
+                        del self.pending_fingerprints[nzbo.fingerprint]
+
+def write_releases(batch):
+    """
+    Inserts a batch of NZBs and their manifest entries in a single
+    transaction.
+
+    :param batch: A list of (nzbo, filename, path, stat, parsed) tuples,
+                  parsed being the PARSED_COLUMNS values of the release.
+                  nzbo is None for releases that already exist, whose path
+                  and parsed values are updated in case the file moved or
+                  the release predates them, and filename is also None for
+                  files that couldn't be parsed. Values a name doesn't tell,
+                  like the episode of an obfuscated re-upload copied from
+                  the known release, are kept.
+    :return: The number of releases written.
+    """
+    ingested_at = int(time.time())
+    rows = [(nzbo.filename, nzbo.name, nzbo.raw_size, nzbo.mtype, nzbo.imdb_id,
+             nzbo.season, nzbo.episode, *episode_range(nzbo.episode), nzbo.tmdb_id,
+             nzbo.tmdb_name, nzbo.tmdb_original_name,
+             nzbo.path, nzbo.fingerprint, ingested_at,
+             *(getattr(nzbo, column) for column in ATTRIBUTE_COLUMNS))
+            for nzbo, _, _, _, _ in batch if nzbo is not None]
+    try:
+        # Use parameterized query to prevent SQL injection
+        cursor.executemany(
+            f"""INSERT INTO {TABLE_NAME} (filename, name, raw_size, mtype, imdb_id, season, episode, episode_start, episode_end, tmdb_id, tmdb_name, tmdb_original_name, path, fingerprint, ingested_at, {', '.join(ATTRIBUTE_COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, {', '.join('?' * len(ATTRIBUTE_COLUMNS))})
+            ON CONFLICT (filename) DO UPDATE SET name = excluded.name, raw_size = excluded.raw_size, mtype = excluded.mtype, imdb_id = excluded.imdb_id, season = excluded.season, episode = excluded.episode, episode_start = excluded.episode_start, episode_end = excluded.episode_end, tmdb_id = excluded.tmdb_id, tmdb_name = excluded.tmdb_name, tmdb_original_name = excluded.tmdb_original_name, path = excluded.path, fingerprint = excluded.fingerprint, {', '.join(f'{column} = excluded.{column}' for column in ATTRIBUTE_COLUMNS)}""",
+            rows)
+        # Releases from before ingest times were recorded take the mtime of
+        # their NZB
+        assignments = ["ingested_at = coalesce(ingested_at, ?)",
+                       *(f"{column} = coalesce(?, {column})"
+                         for column in ('episode_start', 'episode_end', *PARSED_COLUMNS))]
+        cursor.executemany(
+            f"UPDATE {TABLE_NAME} SET path = ?, {', '.join(assignments)} WHERE filename = ?",
+            [(path, file_stat[1] // 1_000_000_000, *episode_range(parsed[PARSED_COLUMNS.index('episode')]),
+              *parsed, filename)
+             for nzbo, filename, path, file_stat, parsed in batch
+             if nzbo is None and filename is not None])
+        cursor.executemany(
+            "INSERT OR REPLACE INTO manifest (path, size, mtime_ns, inode) VALUES (?, ?, ?, ?)",
+            [(path, *file_stat) for _, _, path, file_stat, _ in batch])
+        bump_generation(cursor)
+        conn.commit()
+        logging.debug(f"Wrote a batch of {len(rows)} releases")
+        return len(rows)
     except sqlite3.Error as e:
-        logging.error(f"Error processing NZB file {file_path}: {e}")
+        logging.error(f"Error writing a batch of {len(rows)} releases: {e}")
+        conn.rollback()
+        return 0
+
+def load_manifest():
+    """Loads the manifest as a dictionary of path to (size, mtime_ns, inode)."""
+    cursor.execute("SELECT path, size, mtime_ns, inode FROM manifest")
+    return {row[0]: tuple(row[1:]) for row in cursor.fetchall()}
+
+def get_manifest_entry(path):
+    """Returns the (size, mtime_ns, inode) recorded for a path, or None."""
+    cursor.execute("SELECT size, mtime_ns, inode FROM manifest WHERE path = ?", (path,))
+    row = cursor.fetchone()
+    return tuple(row) if row else None
+
+def remove_missing_files(paths):
+    """Removes the manifest entries and releases of files that disappeared."""
+    try:
+        params = [(path,) for path in paths]
+        cursor.executemany(f"DELETE FROM {TABLE_NAME} WHERE path = ?", params)
+        cursor.executemany("DELETE FROM manifest WHERE path = ?", params)
+        bump_generation(cursor)
+        conn.commit()
+    except sqlite3.Error as e:
+        logging.error(f"Error removing {len(paths)} missing files: {e}")
         conn.rollback()
-    except Exception as e:
-        logging.exception(
-            f"An unexpected error occurred while processing {file_path}: {e}")
 
 def create_db_and_table():
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS releases (
-        filename TEXT PRIMARY KEY,
-        raw_size INTEGER,
-        mtype TEXT,
-        imdb_id TEXT,
-        season INTEGER,
-        tmdb_name TEXT
-    )
-    """)
-    conn.commit()
+    # WAL lets the indexer's read-only connections read while we write
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    migrate(conn)
+
+def scan_nzb_dir(dir_path):
+    """
+    Lists a single directory.
+
+    :return: A (files, subdirs) tuple, where files are the (path, stat) pairs
+             of the NZBs in the directory, using the stat of their DirEntry.
+    :raises OSError: If the directory can't be listed.
+    """
+    files = []
+    subdirs = []
+    with os.scandir(dir_path) as it:
+        for entry in it:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.name.endswith(".nzb") and entry.is_file():
+                    st = entry.stat()
+                    files.append((entry.path, (st.st_size, st.st_mtime_ns, st.st_ino)))
+            except OSError as e:
+                logging.warning(f"Failed to stat {entry.path}: {e}")
+    return files, subdirs
+
+async def iter_nzb_files(root, failed=None):
+    """
+    Yields the (path, stat) pairs of every NZB file under `root`.
+
+    Directories are listed concurrently by CRAWL_WORKERS threads, and files
+    are yielded as soon as their directory has been listed. Only a bounded
+    number of directories are listed ahead of the consumer.
+
+    :param failed: A set the subdirectories that couldn't be listed are
+                   added to, so their files aren't taken for deleted.
+    :raises OSError: If `root` itself can't be listed, e.g. because the
+                     mount isn't up yet.
+    """
+    loop = asyncio.get_running_loop()
+    root = os.path.abspath(root)
+    dirs = deque([root])
+    # Listings in flight, by the directory they list
+    pending = {}
+    with ThreadPoolExecutor(max_workers=CRAWL_WORKERS) as pool:
+        while dirs or pending:
+            while dirs and len(pending) < CRAWL_WORKERS * 2:
+                dir_path = dirs.popleft()
+                pending[loop.run_in_executor(pool, scan_nzb_dir, dir_path)] = dir_path
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                dir_path = pending.pop(future)
+                try:
+                    files, subdirs = future.result()
+                except OSError as e:
+                    if dir_path == root:
+                        raise
+                    logging.error(f"Failed to list {dir_path}: {e}")
+                    if failed is not None:
+                        failed.add(dir_path)
+                    continue
+                dirs.extend(subdirs)
+                for item in files:
+                    yield item
+
+async def iter_changed_files(files, manifest, seen):
+    """
+    Filters out files whose manifest entry matches their stat.
+
+    :param seen: A set every yielded path is added to, changed or not.
+    """
+    async for file_path, file_stat in files:
+        seen.add(file_path)
+        if manifest.get(file_path) != file_stat:
+            yield file_path, file_stat
 
-def load_nzb_data():
-    for filename in os.listdir("."):
-        if filename.endswith(".nzb"):
-            process_single_nzb(filename)
+async def load_nzb_data(client):
+    """
+    Ingests new and changed NZB files through the pipeline, and drops the
+    releases of files that disappeared since the last scan.
+
+    Files under directories that couldn't be listed are kept, so a transient
+    listing error doesn't remove their releases.
+    """
+    started = time.monotonic()
+    manifest = load_manifest()
+    seen = set()
+    failed = set()
+    await IngestPipeline(client).run(
+        iter_changed_files(iter_nzb_files(NZBS_DIR, failed), manifest, seen))
+
+    missing = manifest.keys() - seen
+    if failed:
+        prefixes = tuple(os.path.join(dir_path, '') for dir_path in failed)
+        unlisted = {path for path in missing if path.startswith(prefixes)}
+        logging.warning(f"Keeping {len(unlisted)} files under {len(failed)} directories that couldn't be listed")
+        missing -= unlisted
+    if missing:
+        remove_missing_files(missing)
+    logging.info(
+        f"Scan of {len(seen)} files finished in {time.monotonic() - started:.1f}s, "
+        f"{len(missing)} missing files removed")
+
+class NZBWatcher(FileSystemEventHandler):
+    """
+    Watches a directory tree for new or changed NZB files.
+
+    Bursts of events are debounced per file, and a file is only handed over
+    once its stat stayed the same for WATCH_DEBOUNCE seconds, so files that
+    are still being written aren't parsed yet.
+    """
+
+    def __init__(self, root: str):
+        super().__init__()
+        self.root = root
+        self.loop = None
+        self.wakeup = None
+        # path -> [time of the last event, stat at the last check]
+        self.pending = {}
+        self.observer = Observer()
+
+    def start(self):
+        """Starts watching, must be called from the running event loop."""
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        self.observer.schedule(self, self.root, recursive=True)
+        self.observer.start()
+        logging.info(f"Watching {self.root} for new NZBs")
+
+    def stop(self):
+        self.observer.stop()
+        self.observer.join()
+
+    def _notify(self, path):
+        # Called on the observer thread
+        if path.endswith('.nzb'):
+            self.loop.call_soon_threadsafe(self._add_pending, os.path.abspath(path))
+
+    def _add_pending(self, path):
+        self.pending.setdefault(path, [0, None])[0] = self.loop.time()
+        self.wakeup.set()
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self._notify(event.src_path)
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self._notify(event.src_path)
+
+    def on_closed(self, event):
+        if not event.is_directory:
+            self._notify(event.src_path)
+
+    def on_moved(self, event):
+        if not event.is_directory:
+            self._notify(event.dest_path)
+
+    async def files(self):
+        """Yields the (path, stat) pairs of NZBs that are ready for ingest, forever."""
+        while True:
+            if not self.pending:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+            await asyncio.sleep(WATCH_DEBOUNCE)
+
+            now = self.loop.time()
+            ready = []
+            for path, entry in list(self.pending.items()):
+                if now - entry[0] < WATCH_DEBOUNCE:
+                    continue
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    del self.pending[path]
+                    continue
+                file_stat = (st.st_size, st.st_mtime_ns, st.st_ino)
+                if file_stat != entry[1]:
+                    # Still changing, or checked for the first time
+                    entry[1] = file_stat
+                    continue
+                del self.pending[path]
+                if get_manifest_entry(path) != file_stat:
+                    ready.append((path, file_stat))
+
+            if ready:
+                logging.info(f"Ingesting a batch of {len(ready)} new or changed NZBs")
+            for item in ready:
+                yield item
+
+def catalog_generation():
+    cursor.execute(f"SELECT generation FROM {STATE_TABLE_NAME} WHERE id = 0")
+    return cursor.fetchone()[0]
+
+async def publish_snapshot():
+    """
+    Rebuilds the catalog snapshot in a thread if the catalog changed since
+    the last one was published.
+    """
+    global snapshot_generation
+    if not CATALOG_SNAPSHOT_PATH or catalog_generation() == snapshot_generation:
+        return
+    loop = asyncio.get_running_loop()
+    try:
+        with SNAPSHOT_SECONDS.time():
+            snapshot_generation = await loop.run_in_executor(
+                None, snapshot.build, DATABASE, CATALOG_SNAPSHOT_PATH)
+    except (OSError, sqlite3.Error) as e:
+        logging.error(f"Error publishing the catalog snapshot: {e}")
+
+async def publish_snapshots():
+    """Publishes a new catalog snapshot whenever the catalog changed, forever."""
+    while True:
+        await asyncio.sleep(CATALOG_SNAPSHOT_INTERVAL)
+        await publish_snapshot()
+
+async def watch_nzb_data(client, watcher):
+    """Ingests NZBs reported by the watcher through the pipeline, forever."""
+    await IngestPipeline(client).run(watcher.files())
 
 # Function to parse metadata from nzb
 def parse_nzb_metadata(filepath):
-    m = LordNzb.parser(filepath)
+    m = parse_nzb(filepath)
     return {
-    'filename': m.filename,
-    'name': m.name,
-    'raw_size': m.raw_size
+    'filename': m['filename'],
+    'name': m['name'],
+    'raw_size': m['raw_size'],
+    'fingerprint': m['fingerprint']
     }
 
 # Function to check if an NZB already exists
 def nzb_exists(filename, raw_size):
     cursor.execute(
-        "SELECT COUNT(*) FROM releases WHERE filename = ? AND raw_size = ?",
+        f"SELECT COUNT(*) FROM {TABLE_NAME} WHERE filename = ? AND raw_size = ?",
         (filename, raw_size))
     count = cursor.fetchone()[0]
     return count > 0
 
+# Function to find a release with the same content as an NZB
+def find_release_by_fingerprint(fingerprint):
+    """
+    Looks up the first ingested release of the content with a fingerprint,
+    which its re-uploads are copies of.
+
+    :return: The filename and KNOWN_COLUMNS values of the release as a
+             dictionary, or None if the content is unknown.
+    """
+    if fingerprint is None:
+        return None
+    columns = ('filename', *KNOWN_COLUMNS)
+    cursor.execute(
+        f"SELECT {', '.join(columns)} FROM {TABLE_NAME} WHERE fingerprint = ? ORDER BY rowid LIMIT 1",
+        (fingerprint,))
+    row = cursor.fetchone()
+    return dict(zip(columns, row)) if row else None
+
 async def main():
     """Main function to process NZB files."""
     try:
         create_db_and_table()
-        load_nzb_data()
+        metrics.start_exporter(PRODUCER_METRICS_PORT, PRODUCER_METRICS_TEXTFILE)
 
-        # ... (Get the list of files and process each one)
-        files = [f for f in os.listdir(".") if f.endswith(".nzb")]
-        tasks = [process_single_nzb(file) for file in files]
-        await asyncio.gather(*tasks)
+        watcher = None
+        if PRODUCER_WATCH:
+            # Started before the scan so files created during it aren't missed
+            watcher = NZBWatcher(NZBS_DIR)
+            watcher.start()
+
+        async with TMDBClient(os.environ.get('TMDB_KEY')) as client:
+            await load_nzb_data(client)
+            logging.info(f"TMDB client stats: {client.stats}")
+            await publish_snapshot()
+            if watcher:
+                publisher = asyncio.ensure_future(publish_snapshots())
+                try:
+                    await watch_nzb_data(client, watcher)
+                finally:
+                    publisher.cancel()
+                    watcher.stop()
 
     except Exception as e:
         logging.exception(f"An unexpected error occurred: {e}")
@@ -0,0 +1,356 @@
+import logging
+import re
+import sqlite3
+
+logger = logging.getLogger(__name__)
+
+# Table holding one row per release, written by the producer and searched
+# by the indexer
+TABLE_NAME = "releases"
+# Full-text index over the titles of the releases table
+FTS_TABLE_NAME = "releases_fts"
+# Single row table whose generation is bumped by every write to the catalog,
+# so readers can tell when cached results are stale
+STATE_TABLE_NAME = "catalog_state"
+# Attributes of the release name stored in their own columns, filterable by
+# the indexer, mapped to the keys PTN reports them under. PTN reports the
+# source (WEB-DL, Blu-ray, HDTV...) as the quality, and the group as the
+# encoder.
+ATTRIBUTE_COLUMNS = {
+    'resolution': 'resolution',
+    'source': 'quality',
+    'codec': 'codec',
+    'release_group': 'encoder',
+}
+
+
+def normalize_title(title):
+    """
+    Normalizes a title for exact matching: lowercased, with punctuation and
+    runs of whitespace collapsed to single spaces.
+    """
+    if title is None:
+        return None
+    return " ".join(re.sub(r"[^\w]+", " ", title.lower()).split())
+
+
+def fts_query(text):
+    """
+    Builds an FTS5 query matching every word of `text` as a prefix.
+
+    :return: The query, or None if `text` has no words.
+    """
+    words = re.findall(r"\w+", text.lower())
+    if not words:
+        return None
+    return " ".join(f'"{word}"*' for word in words)
+
+
+def episode_range(episode):
+    """
+    Converts the episode of a release, a number or a multi-episode string
+    like "E01E02", to the range of episodes it covers.
+
+    :return: A tuple of (first, last) episode, or (None, None).
+    """
+    if episode is None:
+        return None, None
+    numbers = [int(n) for n in re.findall(r"\d+", str(episode))]
+    if not numbers:
+        return None, None
+    return min(numbers), max(numbers)
+
+
+def release_attributes(parsed_info):
+    """
+    Picks the attributes stored in ATTRIBUTE_COLUMNS out of the result of
+    PTN.parse for a release name.
+
+    :return: A dictionary of column to value, None for missing attributes.
+    """
+    attributes = {}
+    for column, key in ATTRIBUTE_COLUMNS.items():
+        value = parsed_info.get(key)
+        attributes[column] = str(value) if value not in (None, "") else None
+    return attributes
+
+
+def unique_content(alias):
+    """
+    Builds the SQL condition collapsing releases with the same content, the
+    same NZB uploaded under several names, to the first one ingested. Later
+    uploads often have obfuscated names.
+
+    :param alias: The name the releases table is referred to by in the query.
+    """
+    return (f"NOT EXISTS (SELECT 1 FROM {TABLE_NAME} d "
+            f"WHERE d.fingerprint = {alias}.fingerprint AND d.rowid < {alias}.rowid)")
+
+
+def _columns(cursor, table):
+    cursor.execute(f"PRAGMA table_info({table})")
+    return {row[1] for row in cursor.fetchall()}
+
+
+def _tables(cursor):
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    return {row[0] for row in cursor.fetchall()}
+
+
+def _add_columns(cursor, table, columns):
+    existing = _columns(cursor, table)
+    for name, decl in columns:
+        if name not in existing:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {name} {decl}")
+
+
+def _baseline(cursor):
+    """
+    Brings DBs created before migrations existed to a common baseline.
+
+    The indexer used to read a table called `nzbs`, which is renamed to
+    `releases` if the producer never created one.
+    """
+    tables = _tables(cursor)
+    if 'nzbs' in tables and TABLE_NAME not in tables:
+        cursor.execute(f"ALTER TABLE nzbs RENAME TO {TABLE_NAME}")
+    cursor.execute(f"""
+    CREATE TABLE IF NOT EXISTS {TABLE_NAME} (
+        filename TEXT PRIMARY KEY,
+        raw_size INTEGER,
+        mtype TEXT,
+        imdb_id TEXT,
+        season INTEGER,
+        tmdb_name TEXT,
+        path TEXT
+    )
+    """)
+    # The indexer uses path to resolve downloads without walking NZBS_DIR
+    _add_columns(cursor, TABLE_NAME, [('path', 'TEXT')])
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS releases_path ON {TABLE_NAME} (path)")
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS tmdb_search_cache (
+        mtype TEXT,
+        title TEXT,
+        year INTEGER,
+        tmdb_id INTEGER,
+        fetched_at INTEGER,
+        PRIMARY KEY (mtype, title, year)
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS tmdb_details_cache (
+        mtype TEXT,
+        tmdb_id INTEGER,
+        data TEXT,
+        fetched_at INTEGER,
+        PRIMARY KEY (mtype, tmdb_id)
+    )
+    """)
+    # Stat of every NZB file seen by a scan, so unchanged files can be skipped
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS manifest (
+        path TEXT PRIMARY KEY,
+        size INTEGER,
+        mtime_ns INTEGER,
+        inode INTEGER
+    )
+    """)
+
+
+def _search_columns(cursor):
+    """
+    Adds the columns the indexer reads, a normalized title to match title
+    searches with an index instead of lower(), and indexes for the Newznab
+    search patterns.
+    """
+    _add_columns(cursor, TABLE_NAME, [
+        ('name', 'TEXT'),
+        ('episode', 'TEXT'),
+        ('tmdb_id', 'INTEGER'),
+        ('tmdb_original_name', 'TEXT'),
+        ('title_norm', 'TEXT'),
+    ])
+    cursor.execute(f"UPDATE {TABLE_NAME} SET name = replace(filename, '.nzb', '') WHERE name IS NULL")
+    cursor.execute(f"UPDATE {TABLE_NAME} SET title_norm = normalize_title(tmdb_name)")
+    cursor.execute(f"""
+    CREATE INDEX IF NOT EXISTS releases_mtype_imdb_season
+    ON {TABLE_NAME} (mtype, imdb_id, season)
+    """)
+    cursor.execute(f"""
+    CREATE INDEX IF NOT EXISTS releases_mtype_title
+    ON {TABLE_NAME} (mtype, title_norm)
+    """)
+
+
+def _title_search(cursor):
+    """
+    Adds an FTS5 index over the TMDB names and the release name for ranked
+    title searches, kept in sync with the releases table by triggers.
+    """
+    cursor.execute(f"""
+    CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE_NAME} USING fts5(
+        tmdb_name,
+        tmdb_original_name,
+        name,
+        content='{TABLE_NAME}',
+        content_rowid='rowid',
+        tokenize='unicode61 remove_diacritics 2',
+        prefix='2 3'
+    )
+    """)
+    cursor.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS releases_fts_insert AFTER INSERT ON {TABLE_NAME} BEGIN
+        INSERT INTO {FTS_TABLE_NAME} (rowid, tmdb_name, tmdb_original_name, name)
+        VALUES (new.rowid, new.tmdb_name, new.tmdb_original_name, new.name);
+    END
+    """)
+    cursor.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS releases_fts_delete AFTER DELETE ON {TABLE_NAME} BEGIN
+        INSERT INTO {FTS_TABLE_NAME} ({FTS_TABLE_NAME}, rowid, tmdb_name, tmdb_original_name, name)
+        VALUES ('delete', old.rowid, old.tmdb_name, old.tmdb_original_name, old.name);
+    END
+    """)
+    cursor.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS releases_fts_update
+    AFTER UPDATE OF tmdb_name, tmdb_original_name, name ON {TABLE_NAME} BEGIN
+        INSERT INTO {FTS_TABLE_NAME} ({FTS_TABLE_NAME}, rowid, tmdb_name, tmdb_original_name, name)
+        VALUES ('delete', old.rowid, old.tmdb_name, old.tmdb_original_name, old.name);
+        INSERT INTO {FTS_TABLE_NAME} (rowid, tmdb_name, tmdb_original_name, name)
+        VALUES (new.rowid, new.tmdb_name, new.tmdb_original_name, new.name);
+    END
+    """)
+    cursor.execute(f"INSERT INTO {FTS_TABLE_NAME} ({FTS_TABLE_NAME}) VALUES ('rebuild')")
+
+
+def _catalog_generation(cursor):
+    """
+    Adds the catalog generation counter bumped by the producer in every
+    transaction that changes the releases table.
+    """
+    cursor.execute(f"""
+    CREATE TABLE IF NOT EXISTS {STATE_TABLE_NAME} (
+        id INTEGER PRIMARY KEY CHECK (id = 0),
+        generation INTEGER NOT NULL
+    )
+    """)
+    cursor.execute(f"INSERT OR IGNORE INTO {STATE_TABLE_NAME} (id, generation) VALUES (0, 0)")
+
+
+def _episode_range(cursor):
+    """
+    Adds the episode range of releases as numbers, so episode searches can
+    be filtered with an index, and backfills it from the episode column.
+    Releases written before the episode was stored are backfilled by the
+    next scan, which parses every NZB again once the manifest is forgotten.
+    """
+    _add_columns(cursor, TABLE_NAME, [
+        ('episode_start', 'INTEGER'),
+        ('episode_end', 'INTEGER'),
+    ])
+    cursor.execute(f"SELECT rowid, episode FROM {TABLE_NAME} WHERE episode IS NOT NULL")
+    cursor.executemany(
+        f"UPDATE {TABLE_NAME} SET episode_start = ?, episode_end = ? WHERE rowid = ?",
+        [(*episode_range(episode), rowid) for rowid, episode in cursor.fetchall()])
+    cursor.execute(f"""
+    CREATE INDEX IF NOT EXISTS releases_mtype_imdb_season_episode
+    ON {TABLE_NAME} (mtype, imdb_id, season, episode_start, episode_end)
+    """)
+    cursor.execute("DELETE FROM manifest")
+
+
+def _content_fingerprint(cursor):
+    """
+    Adds the fingerprint of the content of releases, so re-uploads under
+    another name can be recognized, and forgets the manifest so the next
+    scan parses every NZB again and backfills it.
+    """
+    _add_columns(cursor, TABLE_NAME, [('fingerprint', 'TEXT')])
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS releases_fingerprint ON {TABLE_NAME} (fingerprint)")
+    cursor.execute("DELETE FROM manifest")
+
+
+def _ingest_time(cursor):
+    """
+    Adds the time releases were ingested at, in seconds since the epoch, for
+    the RSS feed. Existing releases are left without one, and backfilled by
+    the next scan with the mtime of their NZB.
+    """
+    _add_columns(cursor, TABLE_NAME, [('ingested_at', 'INTEGER')])
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS releases_ingested ON {TABLE_NAME} (ingested_at)")
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS releases_mtype_ingested ON {TABLE_NAME} (mtype, ingested_at)")
+
+
+def _release_attributes(cursor):
+    """
+    Adds the resolution, source, codec and group of releases parsed from
+    their name, compared case-insensitively, with indexes for filtering on
+    them, and forgets the manifest so the next scan parses every NZB again
+    and backfills them.
+    """
+    _add_columns(cursor, TABLE_NAME, [(column, 'TEXT COLLATE NOCASE') for column in ATTRIBUTE_COLUMNS])
+    for column in ATTRIBUTE_COLUMNS:
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS releases_mtype_{column} ON {TABLE_NAME} (mtype, {column})")
+    cursor.execute("DELETE FROM manifest")
+
+
+def _fingerprint_sum(cursor):
+    """
+    Forgets the manifest, so the next scan parses every NZB again and
+    replaces the fingerprints of existing releases with ones summed from
+    the hashes of their message-ids.
+    """
+    cursor.execute("DELETE FROM manifest")
+
+
+def _drop_title_index(cursor):
+    """
+    Drops the index on the normalized title, which title searches stopped
+    using for the FTS5 index. The column is no longer written and is left
+    in place, as dropping it would rewrite the table.
+    """
+    cursor.execute("DROP INDEX IF EXISTS releases_mtype_title")
+
+
+def bump_generation(cursor):
+    """Bumps the catalog generation, within the caller's transaction."""
+    cursor.execute(f"UPDATE {STATE_TABLE_NAME} SET generation = generation + 1 WHERE id = 0")
+
+
+# Applied in order, the schema version of a DB is the number of migrations
+# applied to it. Only ever append to this list.
+MIGRATIONS = [
+    _baseline,
+    _search_columns,
+    _title_search,
+    _catalog_generation,
+    _episode_range,
+    _content_fingerprint,
+    _ingest_time,
+    _release_attributes,
+    _fingerprint_sum,
+    _drop_title_index,
+]
+
+
+def migrate(conn: sqlite3.Connection):
+    """
+    Upgrades the DB in place to the latest schema version.
+
+    Each migration runs in its own transaction together with the update of
+    `PRAGMA user_version`.
+    """
+    conn.create_function('normalize_title', 1, normalize_title, deterministic=True)
+    cursor = conn.cursor()
+    conn.commit()
+    version = cursor.execute("PRAGMA user_version").fetchone()[0]
+    for target, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        logger.info("Migrating DB to schema version %d: %s", target, migration.__name__)
+        cursor.execute("BEGIN")
+        try:
+            migration(cursor)
+            cursor.execute(f"PRAGMA user_version = {target}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
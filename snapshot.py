@@ -0,0 +1,328 @@
+"""
+Compact binary snapshot of the catalog, shared by all indexer workers.
+
+The producer publishes an immutable snapshot of the searchable releases
+after ingest, and indexer workers memory-map it, so N workers share one copy
+of it in the page cache instead of each querying SQLite and building rows.
+
+Layout, all integers little-endian:
+
+- A header with the magic, the format version, the catalog generation the
+  snapshot was built from and the offsets of the sections.
+- Keys sorted by (media type, IMDb ID, season), each pointing at the range of
+  records of its releases. Movies are keyed without a season.
+- Fixed size records, grouped by key and newest first within a key. The
+  text columns of a record are stored as one NUL separated string, so a row
+  is decoded at once, along with a mask of the ones that are NULL.
+- A pool of interned, length-prefixed UTF-8 strings referenced by offset.
+
+Lookups are binary searches over the keys, reading only the pages they touch.
+"""
+import logging
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+import time
+
+from schema import ATTRIBUTE_COLUMNS, STATE_TABLE_NAME, TABLE_NAME, unique_content
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'UDSNAP\0\0'
+VERSION = 3
+# Media types in key order, encoded by their index
+MTYPES = ('movie', 'show')
+# Stand-ins for NULL integers and strings
+NONE_INT = -2 ** 31
+NONE_INT64 = -2 ** 63
+NONE_STR = 0xFFFFFFFF
+# Magic, version, generation, key count, record count and section offsets
+HEADER = struct.Struct('<8sIqIIQQQ')
+# Media type, IMDb ID, season, first record and record count
+KEY = struct.Struct('<BxxxIiII')
+# Text columns, NULL text columns mask, raw size, season, first and last
+# episode, ingest time
+RECORD = struct.Struct('<IIqiiiq')
+STR_LEN = struct.Struct('<I')
+# Columns of the rows returned by lookups, as expected by construct_xml
+COLUMNS = ('name', 'filename', 'raw_size', 'season', 'episode', 'ingested_at', *ATTRIBUTE_COLUMNS)
+# Lowercases ASCII only, like SQLite's NOCASE collation
+_NOCASE = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz')
+# How often readers check whether a new snapshot was published, in seconds
+CHECK_INTERVAL = 1.0
+
+
+def _int(value):
+    return NONE_INT if value is None else value
+
+
+def _none(value, sentinel=NONE_INT):
+    return None if value == sentinel else value
+
+
+def nocase(value):
+    """Folds a string for comparisons like SQLite's NOCASE collation."""
+    return value.translate(_NOCASE)
+
+
+class _StringPool:
+    """Interns strings into a pool of length-prefixed UTF-8 strings."""
+
+    def __init__(self):
+        self.offsets = {}
+        self.data = bytearray()
+
+    def add(self, value):
+        if value is None:
+            return NONE_STR
+        value = str(value)
+        offset = self.offsets.get(value)
+        if offset is None:
+            encoded = value.encode('utf-8', 'surrogateescape')
+            offset = self.offsets[value] = len(self.data)
+            self.data += STR_LEN.pack(len(encoded))
+            self.data += encoded
+        return offset
+
+
+def build(db_path: str, path: str):
+    """
+    Builds a snapshot of the catalog in the DB at `db_path` and atomically
+    publishes it at `path`.
+
+    Releases are read in the order of the keys, so the snapshot is written
+    in a single pass. Duplicate content is collapsed like the indexer does.
+
+    :return: The catalog generation of the snapshot.
+    """
+    started = time.monotonic()
+    conn = sqlite3.connect(db_path)
+    try:
+        # Reads the generation and the releases from the same DB snapshot
+        conn.execute("BEGIN")
+        generation = conn.execute(
+            f"SELECT generation FROM {STATE_TABLE_NAME} WHERE id = 0").fetchone()[0]
+        # Shows are only found by integer seasons, movies regardless of season
+        rows = conn.execute(f"""
+        SELECT r.mtype, r.imdb_id,
+               CASE WHEN r.mtype = 'movie' THEN NULL ELSE r.season END AS key_season,
+               r.filename, r.name, r.episode, r.raw_size, r.season, r.episode_start, r.episode_end,
+               r.ingested_at, {', '.join(f'r.{column}' for column in ATTRIBUTE_COLUMNS)}
+        FROM {TABLE_NAME} r
+        WHERE r.imdb_id IS NOT NULL
+          AND (r.mtype = 'movie' OR (r.mtype = 'show' AND typeof(r.season) = 'integer'))
+          AND {unique_content('r')}
+        ORDER BY r.mtype, r.imdb_id, key_season, r.rowid DESC
+        """)
+
+        pool = _StringPool()
+        keys = bytearray()
+        records = bytearray()
+        n_keys = n_records = 0
+        key = None
+        first = 0
+        for (mtype, imdb_id, key_season, filename, name, episode, raw_size, season,
+             ep_start, ep_end, ingested_at, *attributes) in rows:
+            row_key = (mtype, imdb_id, key_season)
+            if row_key != key:
+                if key is not None:
+                    keys += KEY.pack(MTYPES.index(key[0]), pool.add(key[1]), _int(key[2]),
+                                     first, n_records - first)
+                    n_keys += 1
+                key = row_key
+                first = n_records
+            texts = (name, filename, episode, *attributes)
+            text = "\0".join("" if value is None else str(value) for value in texts)
+            nulls = sum(1 << i for i, value in enumerate(texts) if value is None)
+            records += RECORD.pack(pool.add(text), nulls, NONE_INT64 if raw_size is None else raw_size,
+                                   _int(season), _int(ep_start), _int(ep_end),
+                                   NONE_INT64 if ingested_at is None else ingested_at)
+            n_records += 1
+        if key is not None:
+            keys += KEY.pack(MTYPES.index(key[0]), pool.add(key[1]), _int(key[2]),
+                             first, n_records - first)
+            n_keys += 1
+        conn.rollback()
+    finally:
+        conn.close()
+
+    keys_offset = HEADER.size
+    records_offset = keys_offset + len(keys)
+    pool_offset = records_offset + len(records)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, generation, n_keys, n_records,
+                            keys_offset, records_offset, pool_offset))
+        f.write(keys)
+        f.write(records)
+        f.write(pool.data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    logger.info("Published catalog snapshot of generation %d with %d releases under %d keys in %.2fs",
+                generation, n_records, n_keys, time.monotonic() - started)
+    return generation
+
+
+class Snapshot:
+    """A memory-mapped catalog snapshot."""
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.identity = (st.st_ino, st.st_mtime_ns)
+        (magic, version, self.generation, self.n_keys, self.n_records,
+         self.keys_offset, self.records_offset, self.pool_offset) = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a catalog snapshot of version {VERSION}")
+
+    def _bytes(self, offset):
+        start = self.pool_offset + offset
+        length, = STR_LEN.unpack_from(self.mm, start)
+        start += STR_LEN.size
+        return self.mm[start:start + length]
+
+    def _str(self, offset):
+        if offset == NONE_STR:
+            return None
+        return self._bytes(offset).decode('utf-8', 'surrogateescape')
+
+    def _find(self, mtype, imdb_id, season):
+        """
+        Binary searches the keys.
+
+        :return: A tuple of (first record, record count), or None.
+        """
+        target = (MTYPES.index(mtype), imdb_id.encode('utf-8', 'surrogateescape'), _int(season))
+        lo, hi = 0, self.n_keys
+        while lo < hi:
+            mid = (lo + hi) // 2
+            key_mtype, key_imdb, key_season, first, count = KEY.unpack_from(
+                self.mm, self.keys_offset + mid * KEY.size)
+            key = (key_mtype, self._bytes(key_imdb), key_season)
+            if key == target:
+                return first, count
+            if key < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def search(self, mtype, imdb_id, season=None, episode=None, offset=0, limit=-1, attributes=()):
+        """
+        Looks up the releases of a show season, optionally only those of one
+        episode, or of a movie, newest first.
+
+        :param season: The season of a show, ignored for movies.
+        :param episode: The episode to filter shows on, None for all.
+        :param offset: The number of releases to skip.
+        :param limit: The maximum number of releases, -1 for no limit.
+        :param attributes: Pairs of (attribute column, accepted values folded
+                           with nocase) the releases must match.
+        :return: A tuple of (total, rows), rows being tuples of COLUMNS.
+        """
+        if imdb_id is None:
+            return 0, []
+        if mtype == 'movie':
+            season = None
+        else:
+            try:
+                season = int(season)
+            except (TypeError, ValueError):
+                return 0, []
+        found = self._find(mtype, imdb_id, season)
+        if found is None:
+            return 0, []
+        first, count = found
+
+        start = self.records_offset + first * RECORD.size
+        records = RECORD.iter_unpack(self.mm[start:start + count * RECORD.size])
+        if episode is not None:
+            records = [r for r in records if r[4] != NONE_INT and r[4] <= episode <= r[5]]
+        else:
+            records = list(records)
+        end = None if limit < 0 else offset + limit
+        if not attributes:
+            return len(records), [self._row(*record) for record in records[offset:end]]
+        # Attributes are only known once the rows are decoded
+        rows = [self._row(*record) for record in records]
+        for column, values in attributes:
+            i = COLUMNS.index(column)
+            rows = [row for row in rows if row[i] is not None and nocase(row[i]) in values]
+        return len(rows), rows[offset:end]
+
+    def _row(self, text, nulls, raw_size, season, _, __, ingested_at):
+        texts = [None if nulls & (1 << i) else value
+                 for i, value in enumerate(self._str(text).split("\0"))]
+        name, filename, episode, *attributes = texts
+        return (name, filename, _none(raw_size, NONE_INT64), _none(season),
+                episode, _none(ingested_at, NONE_INT64), *attributes)
+
+
+class SnapshotCursor:
+    """Serves the rows of a snapshot lookup through the cursor interface."""
+
+    description = tuple((name, None, None, None, None, None, None) for name in COLUMNS)
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.position = 0
+
+    def fetchmany(self, size):
+        rows = self.rows[self.position:self.position + size]
+        self.position += len(rows)
+        return rows
+
+    def fetchall(self):
+        return self.fetchmany(len(self.rows))
+
+
+class SnapshotReader:
+    """
+    Keeps the latest published snapshot mapped.
+
+    The path is checked for a new snapshot at most once per CHECK_INTERVAL.
+    A new snapshot replaces the current one atomically. Requests still
+    reading the old one keep their reference, and it is unmapped once the
+    last of them is done.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.snapshot = None
+        self.checked = 0
+        self.lock = threading.Lock()
+
+    def _check(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            self.snapshot = None
+            return
+        if self.snapshot is not None and self.snapshot.identity == (st.st_ino, st.st_mtime_ns):
+            return
+        try:
+            self.snapshot = Snapshot(self.path)
+            logger.info("Mapped catalog snapshot of generation %d", self.snapshot.generation)
+        except (OSError, ValueError, struct.error) as e:
+            logger.warning("Could not map catalog snapshot %s: %s", self.path, e)
+            self.snapshot = None
+
+    def get(self, generation):
+        """
+        Returns the current snapshot if it was built from the given catalog
+        generation, None otherwise so callers fall back to the DB.
+        """
+        now = time.monotonic()
+        if now - self.checked >= CHECK_INTERVAL:
+            with self.lock:
+                if now - self.checked >= CHECK_INTERVAL:
+                    self._check()
+                    self.checked = now
+        snapshot = self.snapshot
+        if snapshot is None or generation is None or snapshot.generation != generation:
+            return None
+        return snapshot
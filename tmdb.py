@@ -0,0 +1,177 @@
+import asyncio
+import logging
+import os
+import random
+import time
+
+import aiohttp
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+TMDB_API_URL = os.environ.get('TMDB_API_URL', 'https://api.themoviedb.org/3')
+# Requests per second allowed by the token bucket, and its burst size
+TMDB_RATE_LIMIT = float(os.environ.get('TMDB_RATE_LIMIT', 20))
+TMDB_BURST = int(os.environ.get('TMDB_BURST', 20))
+TMDB_MAX_CONNECTIONS = int(os.environ.get('TMDB_MAX_CONNECTIONS', 10))
+TMDB_MAX_RETRIES = int(os.environ.get('TMDB_MAX_RETRIES', 5))
+TMDB_TIMEOUT = float(os.environ.get('TMDB_TIMEOUT', 30))
+
+# Status codes worth retrying, TMDB answers 429 when rate limited
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+REQUEST_SECONDS = metrics.histogram(
+    'producer_tmdb_request_seconds', "Latency of TMDB API requests", ['endpoint', 'status'])
+
+
+class TokenBucket:
+    """Async token bucket allowing `rate` acquisitions per second."""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class TMDBClient:
+    """
+    Client for the TMDB API shared by every lookup of a producer run.
+
+    Requests go through one pooled session and a token bucket, are retried
+    with exponential backoff on 429 and 5xx responses, and concurrent
+    identical requests are coalesced into a single one.
+
+    Must be created and used from within the running event loop.
+    """
+
+    def __init__(self,
+                 api_key: str,
+                 base_url: str = TMDB_API_URL,
+                 rate: float = TMDB_RATE_LIMIT,
+                 burst: int = TMDB_BURST,
+                 max_connections: int = TMDB_MAX_CONNECTIONS,
+                 max_retries: int = TMDB_MAX_RETRIES):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip('/')
+        self.max_connections = max_connections
+        self.max_retries = max_retries
+        self.bucket = TokenBucket(rate, burst)
+        self.session = None
+        self.inflight = {}
+        self.stats = {'requests': 0, 'retries': 0, 'coalesced': 0, 'errors': 0}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def _get_session(self):
+        # Created on first use, so runs served entirely from cache open no sockets
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+                timeout=aiohttp.ClientTimeout(total=TMDB_TIMEOUT))
+        return self.session
+
+    async def get(self, path: str, params: dict = None):
+        """
+        Fetches a TMDB API path and returns the decoded JSON.
+
+        :raises aiohttp.ClientError: Once retries are exhausted.
+        """
+        params = params or {}
+        key = (path, tuple(sorted(params.items())))
+        task = self.inflight.get(key)
+        if task is not None:
+            self.stats['coalesced'] += 1
+        else:
+            task = asyncio.ensure_future(self._fetch(path, params))
+            self.inflight[key] = task
+            task.add_done_callback(lambda _: self.inflight.pop(key, None))
+        # Shielded so a cancelled caller doesn't cancel the other waiters
+        return await asyncio.shield(task)
+
+    async def _fetch(self, path, params):
+        url = f"{self.base_url}/{path.lstrip('/')}"
+        # search, tv or movie
+        endpoint = path.lstrip('/').split('/', 1)[0]
+        query = dict(params)
+        if self.api_key:
+            query['api_key'] = self.api_key
+        attempt = 0
+        while True:
+            await self.bucket.acquire()
+            self.stats['requests'] += 1
+            delay = None
+            started = time.perf_counter()
+            status = "error"
+            try:
+                async with self._get_session().get(url, params=query) as response:
+                    status = response.status
+                    if response.status in RETRY_STATUSES and attempt < self.max_retries:
+                        delay = self._retry_after(response, attempt)
+                        logger.debug("TMDB returned %s for %s, retrying in %.1fs",
+                                     response.status, path, delay)
+                    else:
+                        response.raise_for_status()
+                        return await response.json()
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if attempt >= self.max_retries:
+                    self.stats['errors'] += 1
+                    raise
+                delay = self._backoff(attempt)
+                logger.debug("TMDB request for %s failed (%s), retrying in %.1fs",
+                             path, e, delay)
+            except aiohttp.ClientError:
+                self.stats['errors'] += 1
+                raise
+            finally:
+                REQUEST_SECONDS.observe(time.perf_counter() - started,
+                                        endpoint=endpoint, status=status)
+            attempt += 1
+            self.stats['retries'] += 1
+            await asyncio.sleep(delay)
+
+    def _retry_after(self, response, attempt):
+        retry_after = response.headers.get('Retry-After')
+        if retry_after is not None:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        return self._backoff(attempt)
+
+    @staticmethod
+    def _backoff(attempt):
+        return min(60, 2 ** attempt) * (0.5 + random.random() / 2)
+
+    async def search(self, kind: str, query: str):
+        """Searches for `kind` ("tv" or "movie") and returns the results."""
+        data = await self.get(f"search/{kind}", {'query': query})
+        return data['results']
+
+    async def details(self, kind: str, tmdb_id: int):
+        """Fetches the details of a show or movie, including external ids."""
+        return await self.get(f"{kind}/{tmdb_id}",
+                              {'append_to_response': 'external_ids'})